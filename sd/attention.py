@@ -2,6 +2,97 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+# "naive" materialises the full attention matrix, "sliced" processes the queries in chunks,
+# "sdpa" uses torch.nn.functional.scaled_dot_product_attention
+ATTENTION_BACKENDS = ("naive", "sliced", "sdpa")
+_attention_backend = "naive"
+# Number of queries per chunk for the "sliced" backend
+_attention_slice_size = 1024
+# Contexts whose K/V projections each CrossAttention keeps, e.g. the conditional and the unconditional prompts
+# of sequential classifier-free guidance
+KV_CACHE_SLOTS = 2
+
+def set_attention_backend(backend, module=None, slice_size=None):
+    """
+    Select the attention backend, globally or only for the attention layers inside `module`.
+
+    Args:
+        backend (str): One of ATTENTION_BACKENDS. For a module, None goes back to the global backend.
+        module (nn.Module, optional): Model or block whose attention layers get the backend.
+        slice_size (int, optional): Queries per chunk for the "sliced" backend.
+    """
+    global _attention_backend, _attention_slice_size
+    if backend is not None and backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend '{backend}'. Use one of {', '.join(ATTENTION_BACKENDS)}.")
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        logger.warning("scaled_dot_product_attention needs PyTorch 2.0 or newer, using the sliced attention backend instead")
+        backend = "sliced"
+
+    if module is None:
+        if backend is None:
+            raise ValueError("A global attention backend is required")
+        _attention_backend = backend
+        if slice_size is not None:
+            _attention_slice_size = slice_size
+        logger.info("Attention backend: %s", backend)
+        return
+
+    for layer in module.modules():
+        if isinstance(layer, (SelfAttention, CrossAttention)):
+            layer.attention_backend = backend
+            layer.attention_slice_size = slice_size
+    logger.info("Attention backend for %s: %s", type(module).__name__, backend or f"global ({_attention_backend})")
+
+def get_attention_backend():
+    return _attention_backend
+
+def dot_product_attention(q, k, v, causal_mask=False, backend=None, slice_size=None):
+    # q: (Batch_Size, H, Seq_Len_Q, Dim / H)
+    # k: (Batch_Size, H, Seq_Len_KV, Dim / H)
+    # v: (Batch_Size, H, Seq_Len_KV, Dim / H)
+    backend = backend or _attention_backend
+
+    if backend == "sdpa":
+        # (Batch_Size, H, Seq_Len_Q, Dim / H)
+        return F.scaled_dot_product_attention(q, k, v, is_causal=causal_mask)
+
+    if backend == "sliced":
+        slice_size = slice_size or _attention_slice_size
+        seq_len_q = q.shape[-2]
+        if seq_len_q > slice_size:
+            # (Batch_Size, H, Seq_Len_Q, Dim / H)
+            output = torch.empty(q.shape[:-1] + v.shape[-1:], dtype=q.dtype, device=q.device)
+            for start in range(0, seq_len_q, slice_size):
+                end = min(start + slice_size, seq_len_q)
+                # Only a (Batch_Size, H, Slice_Size, Seq_Len_KV) block of the weights exists at a time
+                output[:, :, start:end] = _naive_attention(q[:, :, start:end], k, v, causal_mask, start)
+            return output
+
+    return _naive_attention(q, k, v, causal_mask)
+
+def _naive_attention(q, k, v, causal_mask=False, query_offset=0):
+    # (Batch_Size, H, Seq_Len_Q, Dim / H) @ (Batch_Size, H, Dim / H, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight = q @ k.transpose(-1, -2)
+
+    if causal_mask:
+        # Mask where the upper triangle (above the principal diagonal) is 1, shifted for a slice of the queries
+        mask = torch.ones_like(weight, dtype=torch.bool).triu(1 + query_offset)
+        # Fill the upper triangle with -inf
+        weight.masked_fill_(mask, -torch.inf)
+
+    # Divide by d_k (Dim / H).
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight /= math.sqrt(q.shape[-1])
+
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight = F.softmax(weight, dim=-1)
+
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) @ (Batch_Size, H, Seq_Len_KV, Dim / H) -> (Batch_Size, H, Seq_Len_Q, Dim / H)
+    return weight @ v
 
 class SelfAttention(nn.Module):
     def __init__(self, n_heads, d_embed, in_proj_bias=True, out_proj_bias=True):
@@ -12,6 +103,9 @@ class SelfAttention(nn.Module):
         self.out_proj = nn.Linear(d_embed, d_embed, bias=out_proj_bias)
         self.n_heads = n_heads
         self.d_head = d_embed // n_heads
+        # None follows the global backend, see set_attention_backend
+        self.attention_backend = None
+        self.attention_slice_size = None
 
     def forward(self, x, causal_mask=False):
         # x: # (Batch_Size, Seq_Len, Dim)
@@ -33,24 +127,8 @@ class SelfAttention(nn.Module):
         k = k.view(interim_shape).transpose(1, 2)
         v = v.view(interim_shape).transpose(1, 2)
 
-        # (Batch_Size, H, Seq_Len, Dim / H) @ (Batch_Size, H, Dim / H, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight = q @ k.transpose(-1, -2)
-        
-        if causal_mask:
-            # Mask where the upper triangle (above the principal diagonal) is 1
-            mask = torch.ones_like(weight, dtype=torch.bool).triu(1) 
-            # Fill the upper triangle with -inf
-            weight.masked_fill_(mask, -torch.inf) 
-        
-        # Divide by d_k (Dim / H). 
-        # (Batch_Size, H, Seq_Len, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight /= math.sqrt(self.d_head) 
-
-        # (Batch_Size, H, Seq_Len, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight = F.softmax(weight, dim=-1) 
-
-        # (Batch_Size, H, Seq_Len, Seq_Len) @ (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, H, Seq_Len, Dim / H)
-        output = weight @ v
+        # (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, H, Seq_Len, Dim / H)
+        output = dot_product_attention(q, k, v, causal_mask, self.attention_backend, self.attention_slice_size)
 
         # (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, Seq_Len, H, Dim / H)
         output = output.transpose(1, 2) 
@@ -73,6 +151,12 @@ class CrossAttention(nn.Module):
         self.out_proj = nn.Linear(d_embed, d_embed, bias=out_proj_bias)
         self.n_heads = n_heads
         self.d_head = d_embed // n_heads
+        # None follows the global backend, see set_attention_backend
+        self.attention_backend = None
+        self.attention_slice_size = None
+        # When enabled, the K/V projections of the last KV_CACHE_SLOTS contexts are reused, most recent first
+        self.cache_kv = False
+        self._kv_cache = []
     
     def forward(self, x, y):
         # x (latent): # (Batch_Size, Seq_Len_Q, Dim_Q)
@@ -85,29 +169,30 @@ class CrossAttention(nn.Module):
         
         # (Batch_Size, Seq_Len_Q, Dim_Q) -> (Batch_Size, Seq_Len_Q, Dim_Q)
         q = self.q_proj(x)
-        # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
-        k = self.k_proj(y)
-        # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
-        v = self.v_proj(y)
 
         # (Batch_Size, Seq_Len_Q, Dim_Q) -> (Batch_Size, Seq_Len_Q, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
         q = q.view(interim_shape).transpose(1, 2) 
-        # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
-        k = k.view(interim_shape).transpose(1, 2) 
-        # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
-        v = v.view(interim_shape).transpose(1, 2) 
-        
-        # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) @ (Batch_Size, H, Dim_Q / H, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight = q @ k.transpose(-1, -2)
-        
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight /= math.sqrt(self.d_head)
-        
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight = F.softmax(weight, dim=-1)
+
+        cached = self._lookup_kv(y) if self.cache_kv else None
+        if cached is not None:
+            # Same context as a recent call: reuse its projections
+            k, v = cached
+        else:
+            # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
+            k = self.k_proj(y)
+            # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
+            v = self.v_proj(y)
+
+            # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
+            k = k.view(interim_shape).transpose(1, 2) 
+            # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
+            v = v.view(interim_shape).transpose(1, 2) 
+
+            if self.cache_kv:
+                self._kv_cache = [(y, y._version, k, v)] + self._kv_cache[:KV_CACHE_SLOTS - 1]
         
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) @ (Batch_Size, H, Seq_Len_KV, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
-        output = weight @ v
+        # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
+        output = dot_product_attention(q, k, v, False, self.attention_backend, self.attention_slice_size)
         
         # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) -> (Batch_Size, Seq_Len_Q, H, Dim_Q / H)
         output = output.transpose(1, 2).contiguous()
@@ -119,4 +204,25 @@ class CrossAttention(nn.Module):
         output = self.out_proj(output)
 
         # (Batch_Size, Seq_Len_Q, Dim_Q)
-        return output
\ No newline at end of file
+        return output
+
+    def _lookup_kv(self, y):
+        for entry in self._kv_cache:
+            if entry[0] is y and entry[1] == y._version:
+                return entry[2], entry[3]
+        return None
+
+    def clear_kv_cache(self):
+        self._kv_cache = []
+
+def set_kv_cache(model, enabled=True):
+    # Enable or disable the K/V cache of every CrossAttention in the model, dropping any cached projections
+    for module in model.modules():
+        if isinstance(module, CrossAttention):
+            module.cache_kv = enabled
+            module.clear_kv_cache()
+
+def clear_kv_cache(model):
+    for module in model.modules():
+        if isinstance(module, CrossAttention):
+            module.clear_kv_cache()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import sd.model_loader as model_loader
+import sd.pipeline as pipeline
+from sd.ddim_dss import DDIMDSSSampler, DEFAULT_TOLERANCE, fit_schedule, save_schedule
+from sd.samplers import register_sampler
+from transformers import CLIPTokenizer
+import numpy as np
+import torch
+
+# Runs the adaptive ddim-dss sampler over a set of prompts, records its error profiles and skip decisions,
+# and fits a static schedule for a fixed UNet call budget. The schedule is loaded with
+# DDIMDSSSampler(schedule=OUTPUT_FILE), or sampler_options={"schedule": OUTPUT_FILE}.
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+tokenizer = CLIPTokenizer("./data/vocab.json", merges_file="./data/merges.txt")
+model_file = "./data/v1-5-pruned-emaonly.ckpt"
+
+PROMPTS = [
+    "A cat playing with wool, ultra sharp, photorealistic.",
+    "A dog with sunglasses, wearing comfy hat, looking at camera, highly detailed, ultra sharp, cinematic, 100mm lens, 8k resolution.",
+    "A watercolor painting of a lighthouse on a cliff at sunset.",
+    "A bowl of ramen on a wooden table, studio lighting.",
+    "A futuristic city skyline at night, neon lights, rain.",
+    "Portrait of an old fisherman, dramatic lighting, oil painting.",
+]
+SEEDS = [42, 7]
+CFG_SCALE = 8
+NUM_INFERENCE_STEPS = 50
+WIDTH = 512
+HEIGHT = 512
+
+# The profiles are recorded with this controller tolerance, 0 visits every grid timestep
+CALIBRATION_TOLERANCE = 0.0
+# UNet calls of the fitted schedule, None uses the average of the adaptive runs at the default tolerance
+MAX_NFE = None
+
+OUTPUT_FILE = "./data/dss_schedule.json"
+
+def calibrate():
+    models = model_loader.preload_models_from_standard_weights(model_file, DEVICE)
+
+    # The pipeline builds its own sampler, keep the instances to read their profiles afterwards
+    samplers = []
+    def factory(generator, **options):
+        sampler = DDIMDSSSampler(generator, **options)
+        samplers.append(sampler)
+        return sampler
+    register_sampler("ddim-dss-calibration", "DDIM - DSS calibration", factory)
+
+    def run(prompt, seed, tolerance):
+        for _ in pipeline.generate_iter(
+            prompt=prompt,
+            uncond_prompt="",
+            do_cfg=True,
+            cfg_scale=CFG_SCALE,
+            sampler_name="ddim-dss-calibration",
+            sampler_options={"tolerance": tolerance},
+            n_inference_steps=NUM_INFERENCE_STEPS,
+            models=models,
+            seed=seed,
+            device=DEVICE,
+            idle_device="cpu",
+            tokenizer=tokenizer,
+            kv_cache=True,
+            width=WIDTH,
+            height=HEIGHT,
+        ):
+            pass
+        return samplers[-1]
+
+    profiles = []
+    adaptive_nfe = []
+    for prompt in PROMPTS:
+        for seed in SEEDS:
+            profiles.append(run(prompt, seed, CALIBRATION_TOLERANCE).profile)
+            # Skip decisions of the adaptive controller, for the budget and the report
+            sampler = run(prompt, seed, DEFAULT_TOLERANCE)
+            adaptive_nfe.append(sampler.nfe)
+            skips = [skip for _, _, skip in sampler.profile]
+            print(f"seed {seed}, {sampler.nfe} UNet calls, skips {skips}: {prompt}")
+
+    max_nfe = MAX_NFE or int(round(np.mean(adaptive_nfe)))
+    timesteps = fit_schedule(samplers[-1], profiles, max_nfe)
+
+    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
+    save_schedule(
+        OUTPUT_FILE,
+        timesteps,
+        num_inference_steps=NUM_INFERENCE_STEPS,
+        max_nfe=max_nfe,
+        cfg_scale=CFG_SCALE,
+        num_runs=len(profiles),
+        adaptive_nfe_mean=float(np.mean(adaptive_nfe)),
+    )
+    print(f"Saved {len(timesteps)} step schedule to {OUTPUT_FILE}: {timesteps}")
+
+if __name__ == "__main__":
+    calibrate()
@@ -0,0 +1,23 @@
+import threading
+
+class GenerationCancelled(Exception):
+    pass
+
+class CancellationToken:
+    """
+    Thread-safe flag for stopping a running generation. The pipeline checks it between its phases
+    (text encoding, image encoding, every denoising step, decoding) and raises GenerationCancelled.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled("Generation was cancelled")
@@ -1,86 +1,196 @@
-import torch
+import json
+import math
 import numpy as np
+import torch
+from sd.step_result import StepResult
+from sd.spacing import make_timesteps
+from sd.noise_schedule import NoiseScheduleSampler
 
-class DDIMDSSSampler:
-    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, eta=0.0, skip_threshold=0.01, max_skip_steps=2, min_steps=5):
-        self.generator = generator
-        self.num_train_timesteps = num_training_steps
-        self.eta = eta  # Noise factor (0 = deterministic)
-        self.skip_threshold = skip_threshold  # L2 norm threshold for skipping
-        self.max_skip_steps = max_skip_steps  # Max timesteps to skip at once
-        self.min_steps = min_steps  # Minimum number of steps to ensure quality
+# Allowed local error per step of the adaptive controller
+DEFAULT_TOLERANCE = 0.01
+
+class DDIMDSSSampler(NoiseScheduleSampler):
+    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, tolerance=DEFAULT_TOLERANCE, max_skip_steps=4, max_nfe=None, schedule=None, timestep_spacing="leading"):
+        """
+        DDIM with Dynamic Step Skipping driven by a local error estimate.
 
-        # Noise schedule (linear beta schedule)
-        betas = torch.linspace(beta_start**0.5, beta_end**0.5, num_training_steps) ** 2
-        self.alphas = 1.0 - betas
-        self.alphas_cumprod = torch.cumprod(self.alphas, dim=0)
+        The steps are taken in sigma space, where DDIM is Euler's method. Once the previous step's noise prediction is
+        known, the Euler step and a second-order Adams-Bashforth step over the same interval differ by
+        h^2 / (2 * h_prev) * (eps - eps_prev). This difference is the error estimate. After every UNet call, the largest
+        stride over `timesteps` whose estimate stays within `tolerance` is picked, so the next UNet call runs directly
+        at the chosen timestep. The second-order result is the one kept.
+
+        Args:
+            tolerance: Allowed local error per step, RMS over the latents.
+            max_skip_steps: Largest number of entries of `timesteps` a single step can move forward.
+            max_nfe: Optional budget of UNet calls. Strides are widened when needed to reach the end within it.
+            timestep_spacing: Spacing of the timestep grid, see sd.spacing.make_timesteps.
+            schedule: Static schedule from calibrate_dss.py, as a list of timesteps or the path of a schedule file.
+                The controller is then off: every listed timestep is run, with no error estimate per step.
+        """
+        super().__init__(generator, num_training_steps, beta_start, beta_end, timestep_spacing)
+        self.tolerance = tolerance
+        self.max_skip_steps = max_skip_steps
+        self.max_nfe = max_nfe
+        if isinstance(schedule, str):
+            schedule = load_schedule(schedule)["timesteps"]
+        self.schedule = schedule
 
         # Initialize inference timesteps
         self.set_inference_timesteps(50)
 
     def set_inference_timesteps(self, num_inference_steps=50):
-        """Set the initial timestep sequence for DDIM sampling."""
+        """Set the finest timestep grid the controller can pick from, a static schedule replaces it."""
+        if self.schedule is not None:
+            num_inference_steps = len(self.schedule)
         self.num_inference_steps = num_inference_steps
-        self.step_ratio = self.num_train_timesteps // self.num_inference_steps
-        self.timesteps = (torch.arange(num_inference_steps) * self.step_ratio).flip(0).to(self.alphas_cumprod.device)
-        self.current_step_idx = 0  # Track current position in timesteps
-
-    def set_strength(self, strength=1.0):
-        """Adjust timesteps based on strength for image-to-image tasks."""
-        if not (0.0 < strength <= 1.0):
-            raise ValueError("strength must be in (0, 1]")
-        start_step = int(self.num_inference_steps * (1 - strength))
-        start_step = min(start_step, self.num_inference_steps - 1)
-        self.timesteps = self.timesteps[start_step:]
-        self.current_step_idx = 0
-
-    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor, prev_latents: torch.Tensor = None):
+        if self.schedule is not None:
+            # Karras spacing gives fractional timesteps
+            dtype = torch.float64 if any(isinstance(t, float) for t in self.schedule) else torch.long
+            self._set_timesteps(torch.tensor(self.schedule, dtype=dtype, device=self.alphas_cumprod.device))
+        else:
+            self._set_timesteps(make_timesteps(self.timestep_spacing, num_inference_steps, self.alphas_cumprod).to(self.alphas_cumprod.device))
+
+    def _set_schedule(self):
+        """Precompute sigma of every timestep, step only looks them up with the cursor."""
+        self._sigmas = self._sigma_table(self.timesteps)
+
+        self._step_index = 0  # Track current position in timesteps
+        self.nfe = 0  # UNet calls so far
+        # Noise prediction and sigma interval of the previous step, for the second-order update and the error estimate
+        self._prev_model_output = None
+        self._prev_h = None
+        # (timestep, error rate, skip_count) of every controlled step, read by calibrate_dss.py.
+        # The error rate is the RMS change of the noise prediction per unit of sigma.
+        self.profile = []
+
+    def _choose_skip(self, model_output: torch.Tensor) -> int:
+        """Number of entries of `timesteps` to move forward from the current one."""
+        i = self._step_index
+        remaining = len(self.timesteps) - i
+
+        # Narrowest stride that still reaches the end within the UNet call budget
+        min_skip = 1
+        if self.max_nfe is not None:
+            calls_left = self.max_nfe - self.nfe
+            min_skip = remaining if calls_left <= 0 else math.ceil(remaining / (calls_left + 1))
+        max_skip = min(remaining, max(self.max_skip_steps, min_skip))
+
+        if self.schedule is not None or self._prev_model_output is None:
+            # Static schedule, or nothing to compare against yet
+            return min_skip
+
+        # RMS of the change in the noise prediction, the only reduction (and device sync) of the step
+        eps_change = torch.linalg.vector_norm(model_output - self._prev_model_output).item() / math.sqrt(model_output.numel())
+        error_rate = eps_change / abs(self._prev_h)
+        sigma = self._sigmas[i]
+        skip = min_skip
+        for candidate in range(max_skip, min_skip, -1):
+            sigma_next = self._sigmas[i + candidate]
+            h = sigma_next - sigma
+            # Error estimate in sigma space, scaled back to the UNet's input scale
+            error = h * h / 2 * error_rate / math.sqrt(1 + sigma_next ** 2)
+            if error <= self.tolerance:
+                skip = candidate
+                break
+        self.profile.append((self.timesteps[i].item(), error_rate, skip))
+        return skip
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
         """
-        Perform one DDIM step with dynamic step skipping based on L2 norm.
+        Perform one step, with the stride chosen by the error controller.
         Args:
-            timestep: Current timestep (t).
+            timestep: Current timestep (t), the coefficients are taken from the cursor position.
             latents: Current latent (x_t).
             model_output: Predicted noise from UNet (epsilon_theta).
-            prev_latents: Previous latent (x_{t-1}) for L2 norm calculation.
         Returns:
-            Tuple: (next_latents, next_timestep, skip_count).
+            StepResult: (next_latents, next_timestep, skip_count, nfe).
         """
-        t = timestep
-        step_size = self.step_ratio
-        prev_t = t - step_size
-
-        alpha_t = self.alphas_cumprod[t]
-        alpha_prev = self.alphas_cumprod[prev_t] if prev_t >= 0 else torch.tensor(1.0, dtype=alpha_t.dtype, device=latents.device)
-
-        sqrt_alpha_t = alpha_t.sqrt()
-        sqrt_alpha_prev = alpha_prev.sqrt()
-
-        pred_x0 = (latents - (1 - alpha_t).sqrt() * model_output) / sqrt_alpha_t
-
-        # DDIM update rule
-        sigma_t = self.eta * ((1 - alpha_prev) / (1 - alpha_t) * (1 - alpha_t / alpha_prev)).sqrt()
-        noise = torch.randn(latents.shape, device=latents.device, dtype=latents.dtype, generator=self.generator) if t > 0 else 0.0
-        dir_xt = (1 - alpha_prev - sigma_t ** 2).sqrt() * model_output
-        x_prev = sqrt_alpha_prev * pred_x0 + dir_xt + sigma_t * noise
-
-        # Dynamic step skipping
-        skip_count = 1  # Default: move to next timestep
-        if prev_latents is not None and self.current_step_idx < len(self.timesteps) - self.min_steps:
-            # Compute normalized L2 norm of latent change
-            l2_norm = torch.norm(x_prev - prev_latents, p=2) / torch.norm(x_prev, p=2)
-            if l2_norm < self.skip_threshold:
-                # Skip to a later timestep (up to max_skip_steps)
-                skip_count = min(self.max_skip_steps, len(self.timesteps) - self.current_step_idx - self.min_steps)
-                next_t = self.timesteps[self.current_step_idx + skip_count] if self.current_step_idx + skip_count < len(self.timesteps) else self.timesteps[-self.min_steps]
-            else:
-                next_t = t - step_size if t - step_size >= 0 else 0
+        i = self._step_index
+        self.nfe += 1
+        skip_count = self._choose_skip(model_output)
+
+        sigma = self._sigmas[i]
+        sigma_next = self._sigmas[i + skip_count]
+        h = sigma_next - sigma
+
+        # UNet input scale -> sigma space: x = x_0 + sigma * noise
+        sample = latents * math.sqrt(1 + sigma ** 2)
+        self.pred_original_sample = sample - sigma * model_output
+
+        if self._prev_model_output is None:
+            # Euler step, the same update as DDIM
+            sample = sample.add_(model_output, alpha=h)
         else:
-            next_t = t - step_size if t - step_size >= 0 else 0
+            # Two-step Adams-Bashforth with variable step size
+            ratio = h / (2 * self._prev_h)
+            sample = sample.add_(model_output, alpha=h * (1 + ratio)).add_(self._prev_model_output, alpha=-h * ratio)
+        self._prev_model_output = model_output
+        self._prev_h = h
 
         # Update current step index
-        if next_t in self.timesteps:
-            self.current_step_idx = torch.where(self.timesteps == next_t)[0].item()
-        else:
-            self.current_step_idx += skip_count
+        self._step_index += skip_count
+
+        # Sigma space -> UNet input scale
+        return StepResult(sample.div_(math.sqrt(1 + sigma_next ** 2)), self._next_timestep(), skip_count)
+
+def fit_schedule(sampler, profiles, max_nfe):
+    """
+    Fit a static schedule of max_nfe timesteps taken from the grid `timesteps`, spreading the local error evenly.
+
+    A step of size h in sigma space has a local error of about h^2 / 2 * rate / sqrt(1 + sigma^2), so the error is
+    equidistributed when the grid density follows sqrt(rate / sqrt(1 + sigma^2)).
+
+    Args:
+        sampler: DDIMDSSSampler without a schedule, whose timesteps are the grid to pick from.
+        profiles: One list of (timestep, error rate, skip_count) per calibration run, from DDIMDSSSampler.profile.
+        max_nfe: Number of timesteps (UNet calls) of the fitted schedule.
+
+    Returns:
+        list[int]: Timesteps of the schedule, descending.
+    """
+    timesteps = sampler.timesteps.tolist()
+    max_nfe = min(max_nfe, len(timesteps))
+    grid_sigmas = np.array(sampler._sigmas[:len(timesteps)])
+    index = {t: i for i, t in enumerate(timesteps)}
+
+    # Average error rate at every grid point, interpolated in log sigma between the measured points
+    rates = []
+    for profile in profiles:
+        points = sorted((grid_sigmas[index[t]], rate) for t, rate, _ in profile if t in index)
+        if points:
+            measured_sigmas, measured_rates = zip(*points)
+            rates.append(np.interp(np.log(grid_sigmas), np.log(measured_sigmas), measured_rates))
+    if not rates:
+        raise ValueError("profiles hold no measurements on the timestep grid")
+    rate = np.mean(rates, axis=0)
+
+    # Accumulated sqrt(error density) at the start of every grid step
+    density = np.sqrt(np.maximum(rate, 0) / np.sqrt(1 + grid_sigmas ** 2))
+    widths = np.abs(np.diff(np.append(grid_sigmas, 0.0)))
+    cumulative = np.concatenate([[0.0], np.cumsum(density * widths)])[:-1]
+
+    # Start the steps where the accumulated density crosses equal fractions of its total
+    total = cumulative[-1] + density[-1] * widths[-1]
+    targets = np.arange(max_nfe) * total / max_nfe
+    chosen = sorted(set(int(np.searchsorted(cumulative, target, side="right")) - 1 for target in targets) | {0})
+    # Snapping to the grid can merge neighbours, split the widest gaps until the budget is used
+    while len(chosen) < max_nfe:
+        bounds = chosen + [len(timesteps)]
+        gap, start = max((bounds[k + 1] - bounds[k], bounds[k]) for k in range(len(chosen)))
+        chosen = sorted(chosen + [start + gap // 2])
+    return [timesteps[i] for i in chosen[:max_nfe]]
+
+def save_schedule(path, timesteps, **metadata):
+    """Write a static schedule, with calibration details in metadata, as a small JSON file."""
+    with open(path, "w") as f:
+        json.dump({"timesteps": list(timesteps), **metadata}, f, indent=2)
 
-        return x_prev, next_t, skip_count
\ No newline at end of file
+def load_schedule(path):
+    """Read a schedule file written by save_schedule, returns a dict with at least "timesteps"."""
+    with open(path) as f:
+        data = json.load(f)
+    timesteps = data.get("timesteps")
+    if not timesteps or any(a <= b for a, b in zip(timesteps, timesteps[1:])):
+        raise ValueError(f"{path} does not hold a descending list of timesteps")
+    return data
\ No newline at end of file
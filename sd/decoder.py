@@ -1,7 +1,7 @@
 import torch
 from torch import nn
-from torch.nn import functional as F
 from sd.attention import SelfAttention
+from sd.norm import GroupNormSiLU
 
 class VAE_AttentionBlock(nn.Module):
     def __init__(self, channels):
@@ -44,10 +44,10 @@ class VAE_AttentionBlock(nn.Module):
 class VAE_ResidualBlock(nn.Module):
     def __init__(self, in_channels, out_channels):
         super().__init__()
-        self.groupnorm_1 = nn.GroupNorm(32, in_channels)
+        self.groupnorm_1 = GroupNormSiLU(32, in_channels)
         self.conv_1 = nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1)
 
-        self.groupnorm_2 = nn.GroupNorm(32, out_channels)
+        self.groupnorm_2 = GroupNormSiLU(32, out_channels)
         self.conv_2 = nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1)
 
         if in_channels == out_channels:
@@ -60,21 +60,17 @@ class VAE_ResidualBlock(nn.Module):
 
         residue = x
 
+        # GroupNorm and SiLU
         # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, In_Channels, Height, Width)
         x = self.groupnorm_1(x)
         
-        # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, In_Channels, Height, Width)
-        x = F.silu(x)
-        
         # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         x = self.conv_1(x)
         
+        # GroupNorm and SiLU
         # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         x = self.groupnorm_2(x)
         
-        # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
-        x = F.silu(x)
-        
         # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         x = self.conv_2(x)
         
@@ -154,11 +150,12 @@ class VAE_Decoder(nn.Sequential):
             # (Batch_Size, 128, Height, Width) -> (Batch_Size, 128, Height, Width)
             VAE_ResidualBlock(128, 128), 
             
+            # GroupNorm and SiLU
             # (Batch_Size, 128, Height, Width) -> (Batch_Size, 128, Height, Width)
-            nn.GroupNorm(32, 128), 
+            GroupNormSiLU(32, 128), 
             
-            # (Batch_Size, 128, Height, Width) -> (Batch_Size, 128, Height, Width)
-            nn.SiLU(), 
+            # Keeps the indices of the following layers, and with them the state dict keys
+            nn.Identity(), 
             
             # (Batch_Size, 128, Height, Width) -> (Batch_Size, 3, Height, Width)
             nn.Conv2d(128, 3, kernel_size=3, padding=1), 
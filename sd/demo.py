@@ -1,6 +1,8 @@
 import os
 import sd.model_loader as model_loader
 import sd.pipeline as pipeline
+from sd.prompt_cache import PromptEmbeddingCache
+from sd.attention import set_attention_backend, get_attention_backend
 from PIL import Image
 from pathlib import Path
 from transformers import CLIPTokenizer
@@ -17,6 +19,11 @@ elif torch.backends.mps.is_built() and ALLOW_MPS:
     DEVICE = "mps"
 print(f"Using device: {DEVICE}")
 
+# "naive", "sliced" or "sdpa", see sd.attention.set_attention_backend
+ATTENTION_BACKEND = "sdpa"
+set_attention_backend(ATTENTION_BACKEND)
+print(f"Using attention backend: {get_attention_backend()}")
+
 # Tokenizer (assuming files in sd/data/)
 tokenizer = CLIPTokenizer("./data/vocab.json", merges_file="./data/merges.txt")
 model_file = "./data/v1-5-pruned-emaonly.ckpt"
@@ -24,6 +31,49 @@ model_file = "./data/v1-5-pruned-emaonly.ckpt"
 # Cache models to avoid reloading
 _models = None
 
+# Prompt embeddings are cached in memory and on disk, separately for each checkpoint
+PROMPT_CACHE_DIR = "./data/prompt_cache"
+PROMPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_prompt_cache = None
+
+# Reuse the cross-attention K/V projections of the prompt across denoising steps
+CACHE_CROSS_ATTENTION_KV = True
+
+# Encode and decode with the VAE in tiles of this many latent pixels (None disables tiling)
+VAE_TILE_SIZE = None
+VAE_TILE_OVERLAP = 8
+
+# "leading", "trailing", "linspace" or "karras", see sd.spacing.make_timesteps.
+# "karras" keeps the quality of the multistep samplers (dpm++2m, unipc) at 10-20 steps
+TIMESTEP_SPACING = "leading"
+
+# Stop sampling once the predicted image changes by less than this fraction between steps (None runs every step)
+EARLY_EXIT_TOLERANCE = None
+
+# Apply classifier-free guidance only at timesteps low <= t <= high, e.g. (300, 999) halves the cost
+# of the last steps (None guides every step)
+CFG_INTERVAL = None
+
+# "batched" or "sequential", the latter lowers peak memory for large batches or resolutions, see sd.pipeline.CFG_MODES
+CFG_MODE = "batched"
+
+# Reuse the deep UNet features for DEEP_CACHE_INTERVAL - 1 steps out of every DEEP_CACHE_INTERVAL, running only the
+# outer DEEP_CACHE_DEPTH encoder and decoder stages in between (None computes every step in full)
+DEEP_CACHE_INTERVAL = None
+DEEP_CACHE_DEPTH = 3
+
+# Merge this fraction of the 4096 tokens of the full resolution self-attention (None disables token merging),
+# TOKEN_MERGE_FFN also runs their FFN on the merged tokens
+TOKEN_MERGE_RATIO = None
+TOKEN_MERGE_FFN = False
+
+# Run the UNet feed-forward layers on slices of this many tokens to lower the peak memory (None disables slicing)
+FFN_CHUNK_SIZE = None
+
+# Keep the UNet skip connections and decoder concat inputs in buffers allocated once per latent shape instead of
+# allocating new ones at every step
+PLAN_SKIP_BUFFERS = False
+
 ## TEXT TO IMAGE
 
 # prompt = "A dog with sunglasses, wearing comfy hat, looking at camera, highly detailed, ultra sharp, cinematic, 100mm lens, 8k resolution."
@@ -77,32 +127,54 @@ def generate_image(
     sampler="ddpm",
     num_inference_steps=50,
     seed=42,
-    progress_callback=None
+    progress_callback=None,
+    width=512,
+    height=512,
+    preview_callback=None,
+    cancel_token=None,
+    sampler_options=None
 ):
     """
-    Generate an image using the diffusion pipeline.
+    Generate an image, or a batch of images, using the diffusion pipeline.
     
     Args:
         input_image (PIL.Image.Image, optional): Input image for the pipeline. None for text-to-image.
-        prompt (str): Text prompt for image generation.
-        uncond_prompt (str): Unconditional prompt (default: "").
-        strength (float): Strength of the diffusion process (default: 0.9).
+        prompt (str or list[str]): Text prompt for image generation. A list generates one image per prompt in a single batched run.
+        uncond_prompt (str or list[str]): Unconditional prompt, shared by the batch or one per prompt (default: "").
+        strength (float or list[float]): Strength of the diffusion process, optionally one per prompt (default: 0.9).
         do_cfg (bool): Whether to use classifier-free guidance (default: True).
-        cfg_scale (float): Classifier-free guidance scale (default: 8).
-        sampler (str): Sampler name (default: "ddpm").
+        cfg_scale (float or list[float]): Classifier-free guidance scale, optionally one per prompt (default: 8).
+        sampler (str): Sampler name, any key of sd.samplers.SAMPLERS such as "ddim" or "dpm++2m" (default: "ddpm").
         num_inference_steps (int): Number of inference steps (default: 50).
-        seed (int): Random seed for reproducibility (default: 42).
+        seed (int or list[int]): Random seed for reproducibility, one per prompt for batches (default: 42).
         progress_callback (callable): Callback for progress updates (default: None).
+        width (int): Output width in pixels, a multiple of 64 (default: 512).
+        height (int): Output height in pixels, a multiple of 64 (default: 512).
+        preview_callback (callable): Receives a throttled, approximate RGB preview while sampling (default: None).
+        cancel_token (sd.cancellation.CancellationToken): Stops the generation when cancelled (default: None).
+        sampler_options (dict): Extra sampler settings, e.g. {"tolerance": 0.02, "max_nfe": 15} for "ddim-dss".
+            They override TIMESTEP_SPACING when they set "timestep_spacing" (default: None).
     
     Returns:
-        numpy.ndarray: Generated image as a NumPy array (RGB).
+        numpy.ndarray: Generated image as a NumPy array (RGB), or an array of shape (Batch_Size, Height, Width, 3) when prompt is a list.
     
     Raises:
         FileNotFoundError: If model_file is missing.
+        sd.cancellation.GenerationCancelled: If cancel_token was cancelled.
     """
-    global _models
+    global _models, _prompt_cache
     if _models is None:
         _models = model_loader.preload_models_from_standard_weights(model_file, DEVICE)
+        _models["diffusion"].set_ffn_chunk_size(FFN_CHUNK_SIZE)
+    if _prompt_cache is None:
+        stat = os.stat(model_file)
+        _prompt_cache = PromptEmbeddingCache(
+            namespace=f"{os.path.abspath(model_file)}:{stat.st_size}:{stat.st_mtime_ns}",
+            cache_dir=PROMPT_CACHE_DIR,
+            max_disk_bytes=PROMPT_CACHE_MAX_BYTES,
+        )
+        # The empty negative prompt is used by almost every request
+        _prompt_cache.precompute(_models["clip"], tokenizer, [""], device=DEVICE)
     
     # Use existing pipeline and parameters
     kwargs = {
@@ -112,13 +184,30 @@ def generate_image(
         "do_cfg": do_cfg,
         "cfg_scale": cfg_scale,
         "sampler_name": sampler,
+        "sampler_options": {"timestep_spacing": TIMESTEP_SPACING, **(sampler_options or {})},
         "n_inference_steps": num_inference_steps,
         "seed": seed,
         "models": _models,
         "device": DEVICE,
         "idle_device": "cpu",
         "tokenizer": tokenizer,
-        "progress_callback": progress_callback
+        "progress_callback": progress_callback,
+        "preview_callback": preview_callback,
+        "cancel_token": cancel_token,
+        "early_exit_tolerance": EARLY_EXIT_TOLERANCE,
+        "cfg_interval": CFG_INTERVAL,
+        "cfg_mode": CFG_MODE,
+        "deep_cache_interval": DEEP_CACHE_INTERVAL,
+        "deep_cache_depth": DEEP_CACHE_DEPTH,
+        "token_merge_ratio": TOKEN_MERGE_RATIO,
+        "token_merge_ffn": TOKEN_MERGE_FFN,
+        "plan_skip_buffers": PLAN_SKIP_BUFFERS,
+        "prompt_cache": _prompt_cache,
+        "kv_cache": CACHE_CROSS_ATTENTION_KV,
+        "vae_tile_size": VAE_TILE_SIZE,
+        "vae_tile_overlap": VAE_TILE_OVERLAP,
+        "width": width,
+        "height": height
     }
     if input_image is not None:
         kwargs["input_image"] = input_image
@@ -2,6 +2,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from sd.attention import SelfAttention, CrossAttention
+from sd.token_merging import bipartite_soft_matching
+from sd.memory_planner import SkipBufferPlan
+from sd.norm import GroupNormSiLU
 
 class TimeEmbedding(nn.Module):
     def __init__(self, n_embd):
@@ -10,15 +13,15 @@ class TimeEmbedding(nn.Module):
         self.linear_2 = nn.Linear(4 * n_embd, 4 * n_embd)
 
     def forward(self, x):
-        # x: (1, 320)
+        # x: (1, 320), or (Batch_Size, 320) with one timestep per row
 
-        # (1, 320) -> (1, 1280)
+        # (Batch_Size, 320) -> (Batch_Size, 1280)
         x = self.linear_1(x)
         
-        # (1, 1280) -> (1, 1280)
+        # (Batch_Size, 1280) -> (Batch_Size, 1280)
         x = F.silu(x) 
         
-        # (1, 1280) -> (1, 1280)
+        # (Batch_Size, 1280) -> (Batch_Size, 1280)
         x = self.linear_2(x)
 
         return x
@@ -26,49 +29,60 @@ class TimeEmbedding(nn.Module):
 class UNET_ResidualBlock(nn.Module):
     def __init__(self, in_channels, out_channels, n_time=1280):
         super().__init__()
-        self.groupnorm_feature = nn.GroupNorm(32, in_channels)
+        self.groupnorm_feature = GroupNormSiLU(32, in_channels)
         self.conv_feature = nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1)
         self.linear_time = nn.Linear(n_time, out_channels)
 
-        self.groupnorm_merged = nn.GroupNorm(32, out_channels)
+        self.groupnorm_merged = GroupNormSiLU(32, out_channels)
         self.conv_merged = nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1)
 
         if in_channels == out_channels:
             self.residual_layer = nn.Identity()
         else:
             self.residual_layer = nn.Conv2d(in_channels, out_channels, kernel_size=1, padding=0)
+
+        # Projected time embeddings of a whole sampler schedule, see Diffusion.set_time_table
+        self._time_table = None
+
+    def set_time_table(self, time):
+        # (Num_Timesteps, 1280) -> (Num_Timesteps, Out_Channels)
+        self._time_table = self.linear_time(F.silu(time))
+
+    def clear_time_table(self):
+        self._time_table = None
     
     def forward(self, feature, time):
         # feature: (Batch_Size, In_Channels, Height, Width)
-        # time: (1, 1280)
+        # time: (1, 1280), or (1,) row index into the precomputed time table.
+        # (Batch_Size, 1280) or (Batch_Size,) give every row its own timestep
 
         residue = feature
         
+        # GroupNorm and SiLU
         # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, In_Channels, Height, Width)
         feature = self.groupnorm_feature(feature)
         
-        # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, In_Channels, Height, Width)
-        feature = F.silu(feature)
-        
         # (Batch_Size, In_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         feature = self.conv_feature(feature)
         
-        # (1, 1280) -> (1, 1280)
-        time = F.silu(time)
+        if time.dtype == torch.long:
+            # (Batch_Size,) -> (Batch_Size, Out_Channels)
+            time = self._time_table[time]
+        else:
+            # (Batch_Size, 1280) -> (Batch_Size, 1280)
+            time = F.silu(time)
 
-        # (1, 1280) -> (1, Out_Channels)
-        time = self.linear_time(time)
+            # (Batch_Size, 1280) -> (Batch_Size, Out_Channels)
+            time = self.linear_time(time)
         
-        # Add width and height dimension to time. 
-        # (Batch_Size, Out_Channels, Height, Width) + (1, Out_Channels, 1, 1) -> (Batch_Size, Out_Channels, Height, Width)
+        # Add width and height dimension to time, a single row is broadcast to the whole batch.
+        # (Batch_Size, Out_Channels, Height, Width) + (Batch_Size, Out_Channels, 1, 1) -> (Batch_Size, Out_Channels, Height, Width)
         merged = feature + time.unsqueeze(-1).unsqueeze(-1)
         
+        # GroupNorm and SiLU
         # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         merged = self.groupnorm_merged(merged)
         
-        # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
-        merged = F.silu(merged)
-        
         # (Batch_Size, Out_Channels, Height, Width) -> (Batch_Size, Out_Channels, Height, Width)
         merged = self.conv_merged(merged)
         
@@ -92,6 +106,12 @@ class UNET_AttentionBlock(nn.Module):
         self.linear_geglu_2 = nn.Linear(4 * channels, channels)
 
         self.conv_output = nn.Conv2d(channels, channels, kernel_size=1, padding=0)
+
+        # Token merging around the self-attention, and optionally the FFN, see Diffusion.set_token_merging
+        self.token_merge_ratio = None
+        self.token_merge_ffn = False
+        # Tokens per slice of the FFN, None runs all at once, see Diffusion.set_ffn_chunk_size
+        self.ffn_chunk_size = None
     
     def forward(self, x, context):
         # x: (Batch_Size, Features, Height, Width)
@@ -117,12 +137,20 @@ class UNET_AttentionBlock(nn.Module):
 
         # (Batch_Size, Height * Width, Features)
         residue_short = x
+
+        if self.token_merge_ratio:
+            # Similar tokens are merged once per block, for the self-attention and the FFN
+            merge, unmerge = bipartite_soft_matching(x, h, w, self.token_merge_ratio)
         
         # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x = self.layernorm_1(x)
         
-        # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
-        x = self.attention_1(x)
+        if self.token_merge_ratio:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Seq_Len_Merged, Features) -> (Batch_Size, Height * Width, Features)
+            x = unmerge(self.attention_1(merge(x)))
+        else:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
+            x = self.attention_1(x)
         
         # (Batch_Size, Height * Width, Features) + (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x += residue_short
@@ -148,16 +176,22 @@ class UNET_AttentionBlock(nn.Module):
         
         # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x = self.layernorm_3(x)
-        
-        # GeGLU as implemented in the original code: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/ldm/modules/attention.py#L37C10-L37C10
-        # (Batch_Size, Height * Width, Features) -> two tensors of shape (Batch_Size, Height * Width, Features * 4)
-        x, gate = self.linear_geglu_1(x).chunk(2, dim=-1) 
-        
-        # Element-wise product: (Batch_Size, Height * Width, Features * 4) * (Batch_Size, Height * Width, Features * 4) -> (Batch_Size, Height * Width, Features * 4)
-        x = x * F.gelu(gate)
-        
-        # (Batch_Size, Height * Width, Features * 4) -> (Batch_Size, Height * Width, Features)
-        x = self.linear_geglu_2(x)
+
+        merge_ffn = self.token_merge_ratio and self.token_merge_ffn
+        if merge_ffn:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Seq_Len_Merged, Features)
+            x = merge(x)
+        
+        if self.ffn_chunk_size and x.shape[0] * x.shape[1] > self.ffn_chunk_size:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
+            x = self._chunked_feed_forward(x)
+        else:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
+            x = self._feed_forward(x)
+
+        if merge_ffn:
+            # (Batch_Size, Seq_Len_Merged, Features) -> (Batch_Size, Height * Width, Features)
+            x = unmerge(x)
         
         # (Batch_Size, Height * Width, Features) + (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x += residue_short
@@ -172,6 +206,29 @@ class UNET_AttentionBlock(nn.Module):
         # (Batch_Size, Features, Height, Width) + (Batch_Size, Features, Height, Width) -> (Batch_Size, Features, Height, Width)
         return self.conv_output(x) + residue_long
 
+    def _feed_forward(self, x):
+        # GeGLU as implemented in the original code: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/ldm/modules/attention.py#L37C10-L37C10
+        # (Batch_Size, Height * Width, Features) -> two tensors of shape (Batch_Size, Height * Width, Features * 4)
+        x, gate = self.linear_geglu_1(x).chunk(2, dim=-1) 
+        
+        # Element-wise product: (Batch_Size, Height * Width, Features * 4) * (Batch_Size, Height * Width, Features * 4) -> (Batch_Size, Height * Width, Features * 4)
+        x = x * F.gelu(gate)
+        
+        # (Batch_Size, Height * Width, Features * 4) -> (Batch_Size, Height * Width, Features)
+        return self.linear_geglu_2(x)
+
+    def _chunked_feed_forward(self, x):
+        # Every token goes through the FFN on its own, so slices of ffn_chunk_size tokens give the same result
+        # while the (Tokens, Features * 8) activation only exists for one slice at a time
+        # (Batch_Size, Height * Width, Features) -> (Batch_Size * Height * Width, Features)
+        tokens = x.reshape(-1, x.shape[-1])
+        output = torch.empty_like(tokens)
+        for start in range(0, tokens.shape[0], self.ffn_chunk_size):
+            end = start + self.ffn_chunk_size
+            output[start:end] = self._feed_forward(tokens[start:end])
+        # (Batch_Size * Height * Width, Features) -> (Batch_Size, Height * Width, Features)
+        return output.view(x.shape)
+
 class Upsample(nn.Module):
     def __init__(self, channels):
         super().__init__()
@@ -283,41 +340,132 @@ class UNET(nn.Module):
             SwitchSequential(UNET_ResidualBlock(640, 320), UNET_AttentionBlock(8, 40)),
         ])
 
-    def forward(self, x, context, time):
+        # DeepCache, see Diffusion.set_deep_cache: number of outer encoder and decoder stages that are always run
+        self.deep_cache_depth = None
+        # id(context) -> (context, latent shape, input of the first outer decoder stage)
+        self._deep_cache = {}
+        # (path, latent height and width) -> multiply-accumulates per row, path is "full" or "shallow"
+        self._deep_cache_macs = {}
+        # UNet calls that reused the cached deep features
+        self.deep_cache_hits = 0
+        # Preallocated decoder concat buffers, see Diffusion.set_skip_planning
+        self.skip_planning = False
+        # (latent shape, dtype, device) -> SkipBufferPlan
+        self._skip_plans = {}
+
+    def forward(self, x, context, time, reuse_deep_features=False):
         # x: (Batch_Size, 4, Height / 8, Width / 8)
         # context: (Batch_Size, Seq_Len, Dim) 
-        # time: (1, 1280)
+        # time: (1, 1280) or (Batch_Size, 1280), or the matching row indices into the time tables
+
+        if self.deep_cache_depth is None:
+            return self._run(x, context, time, None)
+
+        cached = self._deep_cache.get(id(context)) if reuse_deep_features else None
+        if cached is not None and (cached[0] is not context or cached[1] != x.shape):
+            # Another context that got the id of a freed one, or other latents
+            cached = None
+        key = ("full" if cached is None else "shallow", tuple(x.shape[2:]))
+        if key in self._deep_cache_macs:
+            output = self._run(x, context, time, cached)
+        else:
+            # Measured once per path and resolution, to report what the cache saves
+            output, macs = _count_macs(self, lambda: self._run(x, context, time, cached))
+            self._deep_cache_macs[key] = macs / x.shape[0]
+        if cached is not None:
+            self.deep_cache_hits += 1
+        return output
+
+    def _run(self, x, context, time, cached):
+        # With cached deep features only the outer deep_cache_depth encoder and decoder stages are run
+        depth = self.deep_cache_depth
+        input_shape = x.shape
+
+        # Full passes without autograd write the skip connections into the planned concat buffers,
+        # the first pass at a new shape records the shapes the plan is made for
+        plan = None
+        planning = self.skip_planning and cached is None and not torch.is_grad_enabled()
+        if planning:
+            plan_key = (tuple(x.shape), x.dtype, x.device)
+            plan = self._skip_plans.get(plan_key)
+            skip_shapes, decoder_input_shapes, concat_channels_last = [], [], []
 
         skip_connections = []
-        for layers in self.encoders:
+        for i, layers in enumerate(self.encoders if cached is None else self.encoders[:depth]):
             x = layers(x, context, time)
-            skip_connections.append(x)
+            if plan is not None:
+                plan.skips[i].copy_(x)
+            else:
+                skip_connections.append(x)
 
-        x = self.bottleneck(x, context, time)
+        if cached is None:
+            x = self.bottleneck(x, context, time)
+            decoders = self.decoders
+        else:
+            x = cached[2]
+            decoders = self.decoders[len(self.decoders) - depth:]
 
-        for layers in self.decoders:
+        for i, layers in enumerate(decoders):
+            if cached is None and depth is not None and i == len(self.decoders) - depth:
+                # Output of the deep branch, the input of the outer decoder stages
+                self._deep_cache[id(context)] = (context, input_shape, x)
             # Since we always concat with the skip connection of the encoder, the number of features increases before being sent to the decoder's layer
-            x = torch.cat((x, skip_connections.pop()), dim=1) 
+            if plan is not None:
+                # The skip connection is already in the tail of the buffer
+                plan.heads[i].copy_(x)
+                x = plan.concats[i]
+            else:
+                if planning:
+                    decoder_input_shapes.append(tuple(x.shape))
+                    skip_shapes.insert(0, tuple(skip_connections[-1].shape))
+                x = torch.cat((x, skip_connections.pop()), dim=1) 
+                if planning:
+                    concat_channels_last.append(not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last))
             x = layers(x, context, time)
+
+        if planning and plan is None:
+            self._skip_plans[plan_key] = SkipBufferPlan(skip_shapes, decoder_input_shapes, x.dtype, x.device, concat_channels_last)
         
         return x
 
 
+def _count_macs(module, run):
+    # Multiply-accumulates of the convolutions, linear layers and attention products inside module during run()
+    macs = 0
+    def count(layer, inputs, output):
+        nonlocal macs
+        if isinstance(layer, nn.Conv2d):
+            macs += output.numel() * layer.in_channels // layer.groups * layer.kernel_size[0] * layer.kernel_size[1]
+        elif isinstance(layer, nn.Linear):
+            macs += output.numel() * layer.in_features
+        else:
+            # Q @ K^T and the weighted sum of V: (Batch_Size, Seq_Len_Q, Dim) x (Batch_Size, Seq_Len_KV, Dim)
+            x = inputs[0]
+            y = inputs[1] if isinstance(layer, CrossAttention) else x
+            macs += 2 * x.shape[0] * x.shape[1] * y.shape[1] * x.shape[2]
+
+    layer_types = (nn.Conv2d, nn.Linear, SelfAttention, CrossAttention)
+    handles = [layer.register_forward_hook(count) for layer in module.modules() if isinstance(layer, layer_types)]
+    try:
+        result = run()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return result, macs
+
 class UNET_OutputLayer(nn.Module):
     def __init__(self, in_channels, out_channels):
         super().__init__()
-        self.groupnorm = nn.GroupNorm(32, in_channels)
+        self.groupnorm = GroupNormSiLU(32, in_channels)
         self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1)
     
     def forward(self, x):
         # x: (Batch_Size, 320, Height / 8, Width / 8)
 
+        # GroupNorm and SiLU
         # (Batch_Size, 320, Height / 8, Width / 8) -> (Batch_Size, 320, Height / 8, Width / 8)
         x = self.groupnorm(x)
         
-        # (Batch_Size, 320, Height / 8, Width / 8) -> (Batch_Size, 320, Height / 8, Width / 8)
-        x = F.silu(x)
-        
         # (Batch_Size, 320, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
         x = self.conv(x)
         
@@ -330,17 +478,121 @@ class Diffusion(nn.Module):
         self.time_embedding = TimeEmbedding(320)
         self.unet = UNET()
         self.final = UNET_OutputLayer(320, 4)
+
+    def set_time_table(self, time):
+        """
+        Precompute the time embedding MLP and every residual block's time projection for a whole schedule in one batched pass.
+        Afterwards forward accepts a (1,) LongTensor row index in place of the (1, 320) time embedding,
+        or a (Batch_Size,) one to run every row at its own timestep.
+
+        Args:
+            time (torch.Tensor): Sinusoidal embeddings of the schedule's timesteps, shape (Num_Timesteps, 320).
+        """
+        # (Num_Timesteps, 320) -> (Num_Timesteps, 1280)
+        time = self.time_embedding(time)
+        for module in self.unet.modules():
+            if isinstance(module, UNET_ResidualBlock):
+                module.set_time_table(time)
+
+    def clear_time_table(self):
+        for module in self.unet.modules():
+            if isinstance(module, UNET_ResidualBlock):
+                module.clear_time_table()
+
+    def set_deep_cache(self, depth=3):
+        """
+        Enable DeepCache (https://arxiv.org/abs/2312.00858). Every full forward keeps the output of the deep UNet branch,
+        and forward(..., reuse_deep_features=True) then only runs the outer `depth` encoder and decoder stages on top of
+        it. The deep features are kept per context tensor, so the conditional and unconditional passes of sequential
+        guidance each get their own.
+
+        Args:
+            depth (int): Outer stages on each side that are always run, 1 to 11. The first 3 run at full latent resolution.
+        """
+        if not 1 <= depth < len(self.unet.encoders):
+            raise ValueError(f"deep cache depth must be between 1 and {len(self.unet.encoders) - 1}")
+        self.unet.deep_cache_depth = depth
+        self.unet._deep_cache = {}
+        self.unet._deep_cache_macs = {}
+        self.unet.deep_cache_hits = 0
+
+    def clear_deep_cache(self):
+        self.unet.deep_cache_depth = None
+        self.unet._deep_cache = {}
+
+    def set_token_merging(self, ratio=0.5, merge_ffn=False, max_downsample=1):
+        """
+        Merge similar tokens before the self-attention of the attention blocks and unmerge them afterwards,
+        see sd.token_merging.bipartite_soft_matching. None or 0 turns it off.
+
+        Args:
+            ratio (float): Fraction of the tokens to remove, up to 0.75.
+            merge_ffn (bool): Also run the GeGLU FFN on the merged tokens.
+            max_downsample (int): Blocks at up to this downsampling of the latents are merged: 1 only the full resolution
+                stages (4096 tokens at 512x512), 2, 4 or 8 include deeper ones.
+        """
+        if ratio and not 0 < ratio <= 0.75:
+            raise ValueError("token merging ratio must be between 0 and 0.75")
+        # Follow the resolution through the UNet: strided convolutions halve it, Upsample doubles it
+        downsample = 1
+        for layers in [*self.unet.encoders, self.unet.bottleneck, *self.unet.decoders]:
+            for layer in layers:
+                if isinstance(layer, nn.Conv2d) and layer.stride == (2, 2):
+                    downsample *= 2
+                elif isinstance(layer, Upsample):
+                    downsample //= 2
+                elif isinstance(layer, UNET_AttentionBlock):
+                    layer.token_merge_ratio = ratio if downsample <= max_downsample else None
+                    layer.token_merge_ffn = merge_ffn
+
+    def set_ffn_chunk_size(self, chunk_size=4096):
+        """
+        Run the GeGLU FFN of the attention blocks on slices of chunk_size tokens (over the whole batch), so that its
+        8x wide intermediate activation is only allocated for one slice at a time. None runs all tokens at once.
+        """
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        for module in self.unet.modules():
+            if isinstance(module, UNET_AttentionBlock):
+                module.ffn_chunk_size = chunk_size
+
+    def set_skip_planning(self, enabled=True):
+        """
+        Keep the decoder stage inputs of the UNet in concat buffers allocated once per latent shape, see
+        sd.memory_planner.SkipBufferPlan. Encoder outputs are copied straight into the skip connection slots of the
+        buffers and the decoder inputs into the rest, so no torch.cat buffer is allocated on later steps. Disabling
+        frees the buffers.
+        """
+        self.unet.skip_planning = enabled
+        self.unet._skip_plans = {}
+
+    def skip_plan_stats(self):
+        """Memory report of every skip buffer plan made so far, by latent shape, see SkipBufferPlan.stats."""
+        return {key[0]: plan.stats for key, plan in self.unet._skip_plans.items()}
+
+    def deep_cache_savings(self, latents_height, latents_width):
+        """Fraction of the UNet work a call with cached deep features skips, None until both paths have run."""
+        macs = self.unet._deep_cache_macs
+        full = macs.get(("full", (latents_height, latents_width)))
+        shallow = macs.get(("shallow", (latents_height, latents_width)))
+        if full is None or shallow is None:
+            return None
+        return 1 - shallow / full
     
-    def forward(self, latent, context, time):
+    def forward(self, latent, context, time, reuse_deep_features=False):
         # latent: (Batch_Size, 4, Height / 8, Width / 8)
         # context: (Batch_Size, Seq_Len, Dim)
-        # time: (1, 320)
+        # time: (1, 320), or (1,) row index into the precomputed time table.
+        # (Batch_Size, 320) or (Batch_Size,) run every row at its own timestep
+        if time.shape[0] not in (1, latent.shape[0]):
+            raise ValueError(f"time has {time.shape[0]} rows, expected 1 or {latent.shape[0]}")
 
-        # (1, 320) -> (1, 1280)
-        time = self.time_embedding(time)
+        if time.dtype != torch.long:
+            # (Batch_Size, 320) -> (Batch_Size, 1280)
+            time = self.time_embedding(time)
         
         # (Batch, 4, Height / 8, Width / 8) -> (Batch, 320, Height / 8, Width / 8)
-        output = self.unet(latent, context, time)
+        output = self.unet(latent, context, time, reuse_deep_features)
         
         # (Batch, 320, Height / 8, Width / 8) -> (Batch, 4, Height / 8, Width / 8)
         output = self.final(output)
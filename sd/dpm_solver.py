@@ -0,0 +1,55 @@
+import math
+import torch
+from sd.step_result import StepResult
+from sd.spacing import alphas_cumprod_at
+from sd.noise_schedule import NoiseScheduleSampler
+
+class DPMSolverMultistepSampler(NoiseScheduleSampler):
+    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, timestep_spacing="leading"):
+        """
+        DPM-Solver++(2M): second-order multistep solver in data (x0) prediction form,
+        see https://arxiv.org/abs/2211.01095. Reuses the previous step's x0, so every step costs one UNet call.
+        """
+        super().__init__(generator, num_training_steps, beta_start, beta_end, timestep_spacing)
+
+        self.set_inference_timesteps(50)
+
+    def _set_schedule(self):
+        # alpha_cumprod of every timestep, followed by 1.0 for the fully denoised end point
+        alphas_cumprod = torch.cat([alphas_cumprod_at(self.alphas_cumprod, self.timesteps).double(), torch.ones(1).double()])
+        # Signal and noise scales of x_t = alpha_t * x_0 + sigma_t * noise, and lambda_t = log(alpha_t / sigma_t)
+        self._alpha_t = alphas_cumprod.sqrt().tolist()
+        self._sigma_t = (1 - alphas_cumprod).sqrt().tolist()
+        self._lambda_t = [math.log(a / s) if s > 0 else float("inf") for a, s in zip(self._alpha_t, self._sigma_t)]
+        self._step_index = 0
+        self._prev_x0 = None
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        i = self._step_index
+        alpha_s, sigma_s = self._alpha_t[i], self._sigma_t[i]
+        alpha_t, sigma_t = self._alpha_t[i + 1], self._sigma_t[i + 1]
+
+        # Data prediction from the predicted noise
+        pred_x0 = (latents - sigma_s * model_output) / alpha_s
+        self.pred_original_sample = pred_x0
+
+        if i + 1 == len(self.timesteps):
+            # The last step lands on the fully denoised latents, first order is used there for stability
+            x_prev = pred_x0
+        else:
+            h = self._lambda_t[i + 1] - self._lambda_t[i]
+            # e^(-h) - 1
+            phi = math.expm1(-h)
+            if self._prev_x0 is None:
+                # First step: DPM-Solver++(1), which is DDIM
+                d = pred_x0
+            else:
+                h_0 = self._lambda_t[i] - self._lambda_t[i - 1]
+                r0 = h_0 / h
+                # D0 + D1 / 2 with D1 = (x0_i - x0_{i-1}) / r0
+                d = pred_x0 + (pred_x0 - self._prev_x0) / (2 * r0)
+            x_prev = (sigma_t / sigma_s) * latents - alpha_t * phi * d
+
+        self._prev_x0 = pred_x0
+        self._step_index += 1
+        return StepResult(x_prev, self._next_timestep())
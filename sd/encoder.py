@@ -2,6 +2,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from sd.decoder import VAE_AttentionBlock, VAE_ResidualBlock
+from sd.norm import GroupNormSiLU
 
 class VAE_Encoder(nn.Sequential):
     def __init__(self):
@@ -51,11 +52,12 @@ class VAE_Encoder(nn.Sequential):
             # (Batch_Size, 512, Height / 8, Width / 8) -> (Batch_Size, 512, Height / 8, Width / 8)
             VAE_ResidualBlock(512, 512), 
             
+            # GroupNorm and SiLU
             # (Batch_Size, 512, Height / 8, Width / 8) -> (Batch_Size, 512, Height / 8, Width / 8)
-            nn.GroupNorm(32, 512), 
+            GroupNormSiLU(32, 512), 
             
-            # (Batch_Size, 512, Height / 8, Width / 8) -> (Batch_Size, 512, Height / 8, Width / 8)
-            nn.SiLU(), 
+            # Keeps the indices of the following layers, and with them the state dict keys
+            nn.Identity(), 
 
             # Because the padding=1, it means the width and height will increase by 2
             # Out_Height = In_Height + Padding_Top + Padding_Bottom
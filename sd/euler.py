@@ -0,0 +1,41 @@
+import torch
+from sd.step_result import StepResult
+from sd.noise_schedule import NoiseScheduleSampler
+
+class EulerSampler(NoiseScheduleSampler):
+    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, ancestral=False, timestep_spacing="leading"):
+        """
+        Euler method on the probability flow ODE in sigma space (Karras et al., https://arxiv.org/abs/2206.00364).
+        The latents passed in and returned stay in the UNet's input scale, the sigma space is only used inside step.
+        With ancestral=True, part of the noise is re-injected at every step (Euler Ancestral).
+        """
+        super().__init__(generator, num_training_steps, beta_start, beta_end, timestep_spacing)
+        self.ancestral = ancestral
+
+        self.set_inference_timesteps(50)
+
+    def _set_schedule(self):
+        self._sigmas = self._sigma_table(self.timesteps)
+        self._step_index = 0
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        sigma = self._sigmas[self._step_index]
+        sigma_next = self._sigmas[self._step_index + 1]
+
+        # UNet input scale -> sigma space: x = x_0 + sigma * noise
+        sample = latents * (1 + sigma ** 2) ** 0.5
+        self.pred_original_sample = sample - sigma * model_output
+
+        if self.ancestral and sigma_next > 0:
+            # Split the step into a deterministic part down to sigma_down and fresh noise of size sigma_up
+            sigma_up = min(sigma_next, (sigma_next ** 2 * (sigma ** 2 - sigma_next ** 2) / sigma ** 2) ** 0.5)
+            sigma_down = (sigma_next ** 2 - sigma_up ** 2) ** 0.5
+            noise = self._randn(latents.shape, latents.device, latents.dtype)
+            sample = sample + (sigma_down - sigma) * model_output + sigma_up * noise
+        else:
+            # The derivative dx/dsigma of the ODE is the predicted noise
+            sample = sample + (sigma_next - sigma) * model_output
+
+        self._step_index += 1
+        # Sigma space -> UNet input scale
+        return StepResult(sample / (1 + sigma_next ** 2) ** 0.5, self._next_timestep())
@@ -0,0 +1,57 @@
+import torch
+from sd.step_result import StepResult
+from sd.noise_schedule import NoiseScheduleSampler
+
+class HeunSampler(NoiseScheduleSampler):
+    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, timestep_spacing="leading"):
+        """
+        Heun's second-order method on the probability flow ODE in sigma space (Karras et al., https://arxiv.org/abs/2206.00364).
+        Every interval needs two UNet calls, so `timesteps` lists every timestep but the first twice and
+        step is called once per UNet call: an Euler step first, then the trapezoidal correction.
+        The last interval, down to sigma = 0, only takes the Euler step.
+        """
+        super().__init__(generator, num_training_steps, beta_start, beta_end, timestep_spacing)
+
+        self.set_inference_timesteps(50)
+
+    def _set_schedule(self):
+        # The grid holds the interval boundaries (t_0, t_1, ..., t_n-1)
+        # (t_0, t_1, t_1, t_2, t_2, ..., t_n-1, t_n-1): one UNet call per entry
+        self.timesteps = torch.cat([self._grid_timesteps[:1], self._grid_timesteps[1:].repeat_interleave(2)])
+        self._sigmas = self._sigma_table(self._grid_timesteps)
+        self._interval = 0
+        self._step_index = 0
+        # Sample and derivative at the start of the interval while waiting for the correction call
+        self._sample = None
+        self._derivative = None
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        sigma = self._sigmas[self._interval]
+        sigma_next = self._sigmas[self._interval + 1]
+        dt = sigma_next - sigma
+
+        if self._sample is None:
+            # Euler step from sigma to sigma_next, the derivative dx/dsigma is the predicted noise
+            # UNet input scale -> sigma space: x = x_0 + sigma * noise
+            sample = latents * (1 + sigma ** 2) ** 0.5
+            self.pred_original_sample = sample - sigma * model_output
+            prev_sample = sample + dt * model_output
+
+            if sigma_next > 0:
+                self._sample = sample
+                self._derivative = model_output
+            else:
+                self._interval += 1
+        else:
+            # Correction: average the derivatives at both ends of the interval
+            sample_next = latents * (1 + sigma_next ** 2) ** 0.5
+            self.pred_original_sample = sample_next - sigma_next * model_output
+            prev_sample = self._sample + dt * (self._derivative + model_output) / 2
+
+            self._sample = None
+            self._derivative = None
+            self._interval += 1
+
+        self._step_index += 1
+        # Sigma space -> UNet input scale
+        return StepResult(prev_sample / (1 + sigma_next ** 2) ** 0.5, self._next_timestep())
@@ -0,0 +1,72 @@
+import torch
+
+class SkipBufferPlan:
+    """
+    Preallocated decoder concat buffers of the UNet for one latent shape, reused by every step.
+
+    The skip connection of every decoder stage is a view of the channel tail of that stage's concat buffer, so encoder
+    outputs are copied straight into their slots and the decoder stage input into the head, instead of keeping the
+    encoder output until a fresh torch.cat buffer is allocated.
+
+    Time steps of one forward: encoder stage i runs at i, the bottleneck at N, decoder stage j concatenates at N + 1 + 2j
+    and runs at N + 2 + 2j. Every concat buffer is filled from the encoder stage of its skip connection until its
+    decoder stage runs, so all of them are alive at the bottleneck and none can share memory.
+    """
+
+    def __init__(self, skip_shapes, decoder_input_shapes, dtype, device, concat_channels_last=None):
+        # skip_shapes: (Batch_Size, Channels, Height, Width) output of every encoder stage
+        # decoder_input_shapes: (Batch_Size, Channels, Height, Width) input of every decoder stage, before the concat
+        # concat_channels_last: whether each concat buffer is laid out channels last
+        n = len(skip_shapes)
+        concat_shapes = [
+            (x[0], x[1] + skip[1], x[2], x[3]) for x, skip in zip(decoder_input_shapes, reversed(skip_shapes))
+        ]
+        concat_channels_last = concat_channels_last or [False] * n
+        self.concats = []
+        for shape, channels_last in zip(concat_shapes, concat_channels_last):
+            # The buffer keeps the memory format torch.cat picks, so the decoder runs the same kernels
+            memory_format = torch.channels_last if channels_last else torch.contiguous_format
+            self.concats.append(torch.empty(shape, dtype=dtype, device=device, memory_format=memory_format))
+        # (Batch_Size, Channels, Height, Width) views: decoder stage j reads its input from heads[j] and the output of
+        # encoder stage N - 1 - j from the tail, skips[i] is the slot of encoder stage i
+        self.heads = [concat[:, :x[1]] for concat, x in zip(self.concats, decoder_input_shapes)]
+        self.skips = [self.concats[n - 1 - i][:, decoder_input_shapes[n - 1 - i][1]:] for i in range(n)]
+
+        # Live elements at every time step without the plan: the skip connections, the decoder inputs and the fresh
+        # concat outputs. With the plan the concat buffers are resident throughout, and only the encoder outputs until
+        # the next stage has read them and the decoder inputs until they are copied into their heads are allocated.
+        concat_time = [n + 1 + 2 * j for j in range(n)]
+        skip_sizes = [_numel(shape) for shape in skip_shapes]
+        skip_lifetimes = [(i, concat_time[n - 1 - i]) for i in range(n)]
+        concat_sizes = [_numel(shape) for shape in concat_shapes]
+        concat_lifetimes = [(t, t + 1) for t in concat_time]
+        x_sizes = [_numel(shape) for shape in decoder_input_shapes]
+        x_lifetimes = [((n if j == 0 else concat_time[j - 1] + 1), concat_time[j]) for j in range(n)]
+        times = range(concat_time[-1] + 2)
+        def live(tensor_sizes, tensor_lifetimes, t):
+            return sum(size for size, (first, last) in zip(tensor_sizes, tensor_lifetimes) if first <= t <= last)
+        unplanned_peak = max(
+            live(skip_sizes + concat_sizes + x_sizes, skip_lifetimes + concat_lifetimes + x_lifetimes, t) for t in times
+        )
+        encoder_output_lifetimes = [(i, i + 1) for i in range(n)]
+        buffer_size = sum(concat_sizes)
+        planned_peak = buffer_size + max(
+            live(skip_sizes + x_sizes, encoder_output_lifetimes + x_lifetimes, t) for t in times
+        )
+
+        element_size = self.concats[0].element_size()
+        self.stats = {
+            "buffer_bytes": buffer_size * element_size,
+            "unplanned_peak_bytes": unplanned_peak * element_size,
+            "planned_peak_bytes": planned_peak * element_size,
+            # Negative when the resident buffers hold more than the peak they remove
+            "peak_bytes_saved": (unplanned_peak - planned_peak) * element_size,
+            # The concat outputs are no longer allocated on every call
+            "allocations_saved_per_call": n,
+        }
+
+def _numel(shape):
+    numel = 1
+    for size in shape:
+        numel *= size
+    return numel
@@ -0,0 +1,102 @@
+import torch
+from sd.spacing import make_timesteps, alphas_cumprod_at
+
+class NoiseScheduleSampler:
+    """
+    Base of the samplers: the training noise schedule, the inference timesteps, strength for image to image and add_noise.
+    Subclasses precompute what their step needs in _set_schedule, which runs whenever the timesteps change.
+    """
+
+    def __init__(self, generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, timestep_spacing="leading"):
+        # Params "beta_start" and "beta_end" taken from: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/configs/stable-diffusion/v1-inference.yaml#L5C8-L5C8
+        # For the naming conventions, refer to the DDPM paper (https://arxiv.org/pdf/2006.11239.pdf)
+        self.betas = torch.linspace(beta_start ** 0.5, beta_end ** 0.5, num_training_steps, dtype=torch.float32) ** 2
+        self.alphas = 1.0 - self.betas
+        self.alphas_cumprod = torch.cumprod(self.alphas, dim=0)
+
+        # A torch.Generator, or a list with one per row of the batch so that every image only depends on its own seed
+        self.generator = generator
+        self.num_train_timesteps = num_training_steps
+        self.timestep_spacing = timestep_spacing  # see sd.spacing.make_timesteps
+
+        # Estimate of the fully denoised latents from the latest step
+        self.pred_original_sample = None
+
+    def set_inference_timesteps(self, num_inference_steps=50):
+        self.num_inference_steps = num_inference_steps
+        self._set_timesteps(make_timesteps(self.timestep_spacing, num_inference_steps, self.alphas_cumprod))
+
+    def set_strength(self, strength=1.0):
+        """
+            Set how much noise to add to the input image.
+            More noise (strength ~ 1) means that the output will be further from the input image.
+            Less noise (strength ~ 0) means that the output will be closer to the input image.
+        """
+        if not (0.0 < strength <= 1.0):
+            raise ValueError("strength must be in (0, 1]")
+        start_step = self._start_step(strength)
+        self.start_step = start_step
+        self._set_timesteps(self._grid_timesteps[start_step:])
+
+    def _start_step(self, strength):
+        # Number of timesteps to skip, at least one step is always run
+        return min(int(self.num_inference_steps * (1 - strength)), self.num_inference_steps - 1)
+
+    def _set_timesteps(self, timesteps):
+        # The grid of timesteps the schedule is made of. Samplers that call the UNet more than once per entry
+        # replace self.timesteps with the expanded list in _set_schedule
+        self._grid_timesteps = timesteps
+        self.timesteps = timesteps
+        self._set_schedule()
+
+    def _set_schedule(self):
+        pass
+
+    def _sigma_table(self, timesteps):
+        # sigma = sqrt((1 - alpha_cumprod) / alpha_cumprod) of every timestep, followed by 0 for the fully denoised end point
+        alphas_cumprod = alphas_cumprod_at(self.alphas_cumprod, timesteps).double()
+        return torch.cat([((1 - alphas_cumprod) / alphas_cumprod).sqrt(), torch.zeros(1).double()]).tolist()
+
+    def _next_timestep(self):
+        # Timestep at the cursor _step_index once step has moved it past the current entry, None after the last one
+        return self.timesteps[self._step_index] if self._step_index < len(self.timesteps) else None
+
+    def _randn(self, shape, device, dtype):
+        # (Batch_Size, 4, Latents_Height, Latents_Width) noise from the sampler's generator, or generators
+        if isinstance(self.generator, (list, tuple)):
+            return batched_randn(shape, self.generator, device, dtype)
+        return torch.randn(shape, generator=self.generator, device=device, dtype=dtype)
+
+    def add_noise(
+        self,
+        original_samples: torch.FloatTensor,
+        timesteps: torch.IntTensor,
+    ) -> torch.FloatTensor:
+        alphas_cumprod = alphas_cumprod_at(self.alphas_cumprod, timesteps.cpu()).to(device=original_samples.device, dtype=original_samples.dtype)
+
+        sqrt_alpha_prod = alphas_cumprod ** 0.5
+        sqrt_alpha_prod = sqrt_alpha_prod.flatten()
+        while len(sqrt_alpha_prod.shape) < len(original_samples.shape):
+            sqrt_alpha_prod = sqrt_alpha_prod.unsqueeze(-1)
+
+        sqrt_one_minus_alpha_prod = (1 - alphas_cumprod) ** 0.5
+        sqrt_one_minus_alpha_prod = sqrt_one_minus_alpha_prod.flatten()
+        while len(sqrt_one_minus_alpha_prod.shape) < len(original_samples.shape):
+            sqrt_one_minus_alpha_prod = sqrt_one_minus_alpha_prod.unsqueeze(-1)
+
+        # Sample from q(x_t | x_0) as in equation (4) of https://arxiv.org/pdf/2006.11239.pdf
+        # Because N(mu, sigma) = X can be obtained by X = mu + sigma * N(0, 1)
+        # here mu = sqrt_alpha_prod * original_samples and sigma = sqrt_one_minus_alpha_prod
+        noise = self._randn(original_samples.shape, original_samples.device, original_samples.dtype)
+        noisy_samples = sqrt_alpha_prod * original_samples + sqrt_one_minus_alpha_prod * noise
+        return noisy_samples
+
+def batched_randn(shape, generators, device=None, dtype=None):
+    """
+    (Batch_Size, ...) standard normal noise where row i is drawn from generators[i], so that every row is the same
+    as drawing it alone from a generator with that seed.
+    """
+    if shape[0] != len(generators):
+        raise ValueError(f"{len(generators)} generators for {shape[0]} rows")
+    # (1, ...) per generator -> (Batch_Size, ...)
+    return torch.cat([torch.randn((1, *shape[1:]), generator=g, device=device, dtype=dtype) for g in generators])
@@ -0,0 +1,13 @@
+from torch import nn
+from torch.nn import functional as F
+
+class GroupNormSiLU(nn.GroupNorm):
+    """
+    GroupNorm followed by SiLU, applied in place to the normalized output so that only one full-size tensor is allocated.
+    A subclass of nn.GroupNorm with the same parameters, so it loads the same state dict keys.
+    """
+
+    def forward(self, x):
+        # (Batch_Size, Channels, Height, Width) -> (Batch_Size, Channels, Height, Width)
+        # group_norm does not keep its output for the backward pass, so it can be overwritten
+        return F.silu(F.group_norm(x, self.num_groups, self.weight, self.bias, self.eps), inplace=True)
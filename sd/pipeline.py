@@ -1,17 +1,99 @@
 import torch
 import time
 import numpy as np
+from dataclasses import dataclass
 from tqdm import tqdm
-from sd.ddpm import DDPMSampler
-from sd.ddim import DDIMSampler
-from sd.ddim_dss import DDIMDSSSampler
+from sd.samplers import get_sampler
+from sd.noise_schedule import batched_randn
+from sd.attention import set_kv_cache
+from sd.vae_tiling import tiled_decode, tiled_encode
+from sd.preview import latents_to_rgb
+from sd.cancellation import CancellationToken
 
 WIDTH = 512
 HEIGHT = 512
-LATENTS_WIDTH = WIDTH // 8
-LATENTS_HEIGHT = HEIGHT // 8
 
-def generate(
+# "batched" runs the conditional and unconditional rows of classifier-free guidance in one UNet call,
+# "sequential" in two calls of half the batch size, for lower peak memory
+CFG_MODES = ("batched", "sequential")
+
+@dataclass
+class StepState:
+    # Position in the sampler's schedule of the step that has just finished, and the schedule length.
+    # Skipped steps are jumped over, so step can advance by more than one.
+    step: int
+    total_steps: int
+    # Fractional with "karras" timestep spacing
+    timestep: float
+    # (Batch_Size, 4, Latents_Height, Latents_Width) after the step
+    latents: torch.Tensor
+    # (Batch_Size, 4, Latents_Height, Latents_Width) the sampler's estimate of the fully denoised latents
+    pred_x0: torch.Tensor
+    # Number of UNet evaluations so far
+    nfe: int
+    # Set on the last state only: the decoded image, or images for a batch
+    images: np.ndarray = None
+    # Set on the last state only: UNet evaluations saved by stopping early once pred_x0 converged
+    skipped_nfe: int = 0
+    # Set on the last state only: UNet evaluations saved by the deep feature cache, in full UNet calls
+    deep_cache_saved_nfe: float = 0.0
+    # Set on the last state only: SkipBufferPlan.stats of the largest UNet batch, with plan_skip_buffers
+    skip_plan_stats: dict = None
+
+@dataclass(eq=False)
+class _RowGroup:
+    # Rows of the batch that share a sampler, and with it a schedule and a position in it
+    sampler: object
+    # (Group_Size,) row indices into the batch, None when the group is the whole batch
+    rows: torch.Tensor
+    row_list: list
+    # Row of the group's first timestep in the time table shared by all groups
+    time_offset: int
+    # Whether each step of the group's schedule runs classifier-free guidance
+    cfg_steps: list
+    cursor: int = 0
+    prev_pred_x0: torch.Tensor = None
+    skipped_nfe: int = 0
+
+    @property
+    def remaining(self):
+        return len(self.sampler.timesteps) - self.cursor
+
+def generate(prompt, *args, progress_callback=None, preview_callback=None, preview_interval=1.0, return_metadata=False, **kwargs):
+    """
+    Run the whole pipeline and return the generated image, or an array of images when prompt is a list.
+    With return_metadata, (images, metadata) is returned, where metadata holds the UNet evaluations
+    that were run ("nfe"), the ones saved by early termination ("skipped_nfe") and the equivalent
+    of the work saved by the deep feature cache ("deep_cache_saved_nfe"), and with plan_skip_buffers the
+    memory report of the skip buffer plan ("skip_plan_stats").
+    progress_callback(step, total_steps, step_time) is called after every sampler step.
+    preview_callback(image) receives an approximate RGB preview of the predicted result,
+    at most once every preview_interval seconds. It gets an array of images when prompt is a list.
+    See generate_iter for the other arguments.
+    """
+    state = None
+    step_start_time = time.time()
+    last_preview_time = None
+    for state in generate_iter(prompt, *args, **kwargs):
+        if state.images is not None:
+            break
+        if progress_callback:
+            step_time = time.time() - step_start_time
+            progress_callback(state.step, state.total_steps, step_time)
+            step_start_time = time.time()
+        if preview_callback and (last_preview_time is None or time.time() - last_preview_time >= preview_interval):
+            previews = latents_to_rgb(state.pred_x0 if state.pred_x0 is not None else state.latents)
+            preview_callback(previews if isinstance(prompt, (list, tuple)) else previews[0])
+            last_preview_time = time.time()
+    if return_metadata:
+        metadata = {"nfe": state.nfe, "skipped_nfe": state.skipped_nfe, "deep_cache_saved_nfe": state.deep_cache_saved_nfe}
+        if state.skip_plan_stats is not None:
+            metadata["skip_plan_stats"] = state.skip_plan_stats
+        return state.images, metadata
+    return state.images
+
+@torch.no_grad()
+def generate_iter(
     prompt,
     uncond_prompt=None,
     input_image=None,
@@ -25,160 +107,410 @@ def generate(
     device=None,
     idle_device=None,
     tokenizer=None,
-    progress_callback=None
+    prompt_cache=None,
+    kv_cache=False,
+    vae_tile_size=None,
+    vae_tile_overlap=8,
+    width=WIDTH,
+    height=HEIGHT,
+    cancel_token=None,
+    early_exit_tolerance=None,
+    cfg_interval=None,
+    cfg_mode="batched",
+    deep_cache_interval=None,
+    deep_cache_depth=3,
+    token_merge_ratio=None,
+    token_merge_ffn=False,
+    plan_skip_buffers=False,
+    sampler_options=None
 ):
-    with torch.no_grad():
-        if not 0 < strength <= 1:
-            raise ValueError("strength must be between 0 and 1")
+    """
+    Run the pipeline step by step. A StepState is yielded after every sampler step,
+    and once more with the decoded images when generation has finished.
+    Stopping the iteration early skips the remaining steps and the decoding.
+    If cancel_token is cancelled, GenerationCancelled is raised at the next phase or step boundary.
+    sampler_options are passed to the sampler's constructor, e.g. {"tolerance": 0.02, "max_nfe": 15} for "ddim-dss".
+    With early_exit_tolerance, sampling stops once the predicted x0 of every image changes by less than this fraction
+    (relative RMS) between two steps, and that prediction is decoded. The saved UNet calls are in the last StepState.
+    cfg_interval=(low, high) applies classifier-free guidance only at timesteps low <= t <= high (training timesteps,
+    0-999). At the other steps the UNet runs on the conditional rows alone, at about half the cost. For example (300, 999)
+    drops guidance in the last, low noise steps, where it mostly sharpens details.
+    cfg_mode="sequential" runs the conditional and unconditional UNet passes one after the other instead of as one
+    batch of twice the size, which halves the peak activation memory for the same result at a small speed cost.
+    strength and cfg_scale may be lists with one value per prompt. Images with different strengths start at different
+    points of the schedule and each get their own sampler, but all rows are still denoised in one UNet call per step,
+    every row at its own timestep. Progress then follows the images with the most steps left.
+    With deep_cache_interval=K, the deep UNet features are computed every K steps and reused in between, where only the
+    outer deep_cache_depth encoder and decoder stages run (see Diffusion.set_deep_cache). The saved work is reported
+    in the last StepState.
+    token_merge_ratio merges that fraction of the tokens before the self-attention of the full resolution attention
+    blocks, and token_merge_ffn also before their FFN (see Diffusion.set_token_merging).
+    plan_skip_buffers writes the UNet skip connections straight into decoder concat buffers allocated once and reused
+    by every step (see Diffusion.set_skip_planning). Their memory report, with the peak saved, is in the last StepState.
+    """
+    if width <= 0 or height <= 0 or width % 64 or height % 64:
+        raise ValueError("width and height must be positive multiples of 64")
+    if cfg_mode not in CFG_MODES:
+        raise ValueError(f"Unknown cfg_mode '{cfg_mode}'. Use one of {', '.join(CFG_MODES)}.")
+    if cfg_interval is not None and not 0 <= cfg_interval[0] <= cfg_interval[1]:
+        raise ValueError("cfg_interval must be (low, high) with 0 <= low <= high")
+    latents_width = width // 8
+    latents_height = height // 8
 
-        if idle_device:
-            to_idle = lambda x: x.to(idle_device)
-        else:
-            to_idle = lambda x: x
+    if idle_device:
+        to_idle = lambda x: x.to(idle_device)
+    else:
+        to_idle = lambda x: x
+
+    # A single prompt returns a single image, a list of prompts returns a batch of images
+    is_batch = isinstance(prompt, (list, tuple))
+    prompts = list(prompt) if is_batch else [prompt]
+    batch_size = len(prompts)
+    if batch_size == 0:
+        raise ValueError("prompt list must not be empty")
+    uncond_prompts = _expand_to_batch(uncond_prompt, batch_size, "uncond_prompt")
+    strengths = _expand_to_batch(strength, batch_size, "strength")
+    if not all(0 < s <= 1 for s in strengths):
+        raise ValueError("strength must be between 0 and 1")
+    cfg_scales = _expand_to_batch(cfg_scale, batch_size, "cfg_scale")
+    uncond_prompts = ["" if p is None else p for p in uncond_prompts]
+    if isinstance(seed, (list, tuple)):
+        seeds = _expand_to_batch(seed, batch_size, "seed")
+    elif seed is None:
+        seeds = [None] * batch_size
+    else:
+        # Consecutive seeds keep every image of the batch reproducible on its own
+        seeds = [seed + i for i in range(batch_size)]
+
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    cancel_token.raise_if_cancelled()
 
-        # Initialize random number generator according to the seed specified
+    # Initialize one random number generator per image according to the seeds specified
+    generators = []
+    for image_seed in seeds:
         generator = torch.Generator(device=device)
-        if seed is None:
+        if image_seed is None:
             generator.seed()
         else:
-            generator.manual_seed(seed)
-
-        clip = models["clip"]
-        clip.to(device)
-        
-        if do_cfg:
-            # Convert into a list of length Seq_Len=77
-            cond_tokens = tokenizer.batch_encode_plus(
-                [prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            cond_tokens = torch.tensor(cond_tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            cond_context = clip(cond_tokens)
-            # Convert into a list of length Seq_Len=77
-            uncond_tokens = tokenizer.batch_encode_plus(
-                [uncond_prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            uncond_context = clip(uncond_tokens)
-            # (Batch_Size, Seq_Len, Dim) + (Batch_Size, Seq_Len, Dim) -> (2 * Batch_Size, Seq_Len, Dim)
-            context = torch.cat([cond_context, uncond_context])
-        else:
-            # Convert into a list of length Seq_Len=77
-            tokens = tokenizer.batch_encode_plus(
-                [prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            tokens = torch.tensor(tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            context = clip(tokens)
-        to_idle(clip)
-
-        if sampler_name == "ddpm":
-            sampler = DDPMSampler(generator)
-            sampler.set_inference_timesteps(n_inference_steps)
-        elif sampler_name == "ddim":
-            sampler = DDIMSampler(generator)
-            sampler.set_inference_timesteps(n_inference_steps)
-        elif sampler_name == "ddim-dss":
-            sampler = DDIMDSSSampler(generator)
-            sampler.set_inference_timesteps(n_inference_steps)
-        else:
-            raise ValueError(f"Unknown sampler value '{sampler_name}'. Use 'ddpm', 'ddim', or 'ddim-dss'.")
+            generator.manual_seed(image_seed)
+        generators.append(generator)
+    if do_cfg:
+        # Encode the prompts and the negative prompts together, the conditional rows come first
+        # (2 * Batch_Size, Seq_Len, Dim)
+        context = encode_prompts(prompts + uncond_prompts, models["clip"], tokenizer, device, to_idle, prompt_cache)
+    else:
+        # (Batch_Size, Seq_Len, Dim)
+        context = encode_prompts(prompts, models["clip"], tokenizer, device, to_idle, prompt_cache)
 
-        latents_shape = (1, 4, LATENTS_HEIGHT, LATENTS_WIDTH)
+    cancel_token.raise_if_cancelled()
 
+    # One sampler per distinct strength, text-to-image uses a single one for the whole batch
+    group_strengths = list(dict.fromkeys(strengths)) if input_image else [None]
+    groups = []
+    time_offset = 0
+    for group_strength in group_strengths:
+        if len(group_strengths) == 1:
+            rows, row_list = None, list(range(batch_size))
+        else:
+            row_list = [i for i, s in enumerate(strengths) if s == group_strength]
+            rows = torch.tensor(row_list, device=device)
+        # Every image draws its own rows of the sampler noise, so it matches a single generation with its seed
+        sampler = get_sampler(sampler_name, [generators[i] for i in row_list], n_inference_steps, **(sampler_options or {}))
         if input_image:
-            encoder = models["encoder"]
-            encoder.to(device)
-
-            input_image_tensor = input_image.resize((WIDTH, HEIGHT))
-            # (Height, Width, Channel)
-            input_image_tensor = np.array(input_image_tensor)
-            # (Height, Width, Channel) -> (Height, Width, Channel)
-            input_image_tensor = torch.tensor(input_image_tensor, dtype=torch.float32, device=device)
-            # (Height, Width, Channel) -> (Height, Width, Channel)
-            input_image_tensor = rescale(input_image_tensor, (0, 255), (-1, 1))
-            # (Height, Width, Channel) -> (Batch_Size, Height, Width, Channel)
-            input_image_tensor = input_image_tensor.unsqueeze(0)
-            # (Batch_Size, Height, Width, Channel) -> (Batch_Size, Channel, Height, Width)
-            input_image_tensor = input_image_tensor.permute(0, 3, 1, 2)
-
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            encoder_noise = torch.randn(latents_shape, generator=generator, device=device)
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
+            sampler.set_strength(strength=group_strength)
+        groups.append(_RowGroup(sampler, rows, row_list, time_offset, cfg_steps=None))
+        time_offset += len(sampler.timesteps)
+
+    # Noise is drawn per image so that each image only depends on its own seed
+    latents_shape = (batch_size, 4, latents_height, latents_width)
+
+    if input_image:
+        encoder = models["encoder"]
+        encoder.to(device)
+
+        input_image_tensor = input_image.resize((width, height))
+        # (Height, Width, Channel)
+        input_image_tensor = np.array(input_image_tensor)
+        # (Height, Width, Channel) -> (Height, Width, Channel)
+        input_image_tensor = torch.tensor(input_image_tensor, dtype=torch.float32, device=device)
+        # (Height, Width, Channel) -> (Height, Width, Channel)
+        input_image_tensor = rescale(input_image_tensor, (0, 255), (-1, 1))
+        # (Height, Width, Channel) -> (Batch_Size, Height, Width, Channel)
+        input_image_tensor = input_image_tensor.unsqueeze(0).repeat(batch_size, 1, 1, 1)
+        # (Batch_Size, Height, Width, Channel) -> (Batch_Size, Channel, Height, Width)
+        input_image_tensor = input_image_tensor.permute(0, 3, 1, 2)
+
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        encoder_noise = batched_randn(latents_shape, generators, device)
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        if vae_tile_size:
+            latents = tiled_encode(encoder, input_image_tensor, encoder_noise, vae_tile_size, vae_tile_overlap)
+        else:
             latents = encoder(input_image_tensor, encoder_noise)
 
-            # Add noise to the latents (the encoded input image)
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            sampler.set_strength(strength=strength)
-            latents = sampler.add_noise(latents, sampler.timesteps[0])
+        # Add noise to the latents (the encoded input image), up to the first timestep of each group
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        for group in groups:
+            noisy = group.sampler.add_noise(_take_rows(latents, group.rows), group.sampler.timesteps[0])
+            latents = _put_rows(latents, group.rows, noisy)
+
+        to_idle(encoder)
+        cancel_token.raise_if_cancelled()
+    else:
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        latents = batched_randn(latents_shape, generators, device)
+
+    diffusion = models["diffusion"]
+    diffusion.to(device)
+    # The context is the same for every step, so the cross-attention K/V projections only need computing once
+    set_kv_cache(diffusion, kv_cache)
+    if deep_cache_interval:
+        diffusion.set_deep_cache(deep_cache_depth)
+    if token_merge_ratio:
+        diffusion.set_token_merging(token_merge_ratio, token_merge_ffn)
+    if plan_skip_buffers:
+        diffusion.set_skip_planning(True)
 
-            to_idle(encoder)
+    # Embed every timestep of the schedules in one batched pass, the loop only looks up their rows
+    # (Num_Timesteps, 320)
+    diffusion.set_time_table(get_time_embedding(torch.cat([g.sampler.timesteps for g in groups])).to(device))
+    # (Num_Timesteps,)
+    time_indices = torch.arange(time_offset, device=device)
+
+    for group in groups:
+        # Steps that run classifier-free guidance, the others only need the conditional rows of the context
+        if do_cfg and cfg_interval is not None:
+            group.cfg_steps = [cfg_interval[0] <= t <= cfg_interval[1] for t in group.sampler.timesteps.tolist()]
         else:
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            latents = torch.randn(latents_shape, generator=generator, device=device)
+            group.cfg_steps = [do_cfg] * len(group.sampler.timesteps)
+    uniform_cfg_scale = len(set(cfg_scales)) == 1
+
+    # Each group's cursor indexes its sampler's timesteps, samplers that skip steps move it forward by more than one.
+    # The reported step follows the group with the most steps left, so that it only moves forward
+    total_steps = max(len(g.sampler.timesteps) for g in groups)
+    progress = tqdm(total=total_steps)
+    active_groups = None
+    pred_x0 = None
+    # Steps run so far, and the ones that reused the deep features of the UNet
+    iteration = 0
+    deep_cached_steps = 0
+    try:
+        nfe = 0
+        while any(g.remaining > 0 for g in groups):
+            # Stops within one step of a cancel request
+            cancel_token.raise_if_cancelled()
 
-        diffusion = models["diffusion"]
-        diffusion.to(device)
+            if active_groups != [g for g in groups if g.remaining > 0]:
+                # The rows taking part changed, or this is the first step
+                active_groups = [g for g in groups if g.remaining > 0]
+                if len(groups) == 1:
+                    active_rows = None
+                    # (Batch_Size, Seq_Len, Dim), the same tensors at every step so the cross-attention K/V cache can hold them
+                    cond_context = context[:batch_size]
+                    uncond_context = context[batch_size:]
+                    full_context = context
+                else:
+                    # (Active_Size,)
+                    active_rows = torch.cat([g.rows for g in active_groups])
+                    cond_context = context[active_rows]
+                    uncond_context = context[active_rows + batch_size] if do_cfg else None
+                    full_context = torch.cat([cond_context, uncond_context]) if do_cfg else None
 
-        prev_latents = None
-        timesteps = tqdm(sampler.timesteps)
-        step_start_time = time.time()
-        for i, timestep in enumerate(timesteps):
-            # (1, 320)
-            time_embedding = get_time_embedding(timestep).to(device)
+            front = max(active_groups, key=lambda g: g.remaining)
+            step = total_steps - front.remaining
+            timestep = front.sampler.timesteps[front.cursor]
 
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            model_input = latents
+            if len(active_groups) == 1:
+                # (1,), broadcast to all rows
+                time_row = active_groups[0].time_offset + active_groups[0].cursor
+                time_embedding = time_indices[time_row:time_row + 1]
+            else:
+                # (Active_Size,), every row at the timestep of its group
+                time_embedding = torch.tensor([g.time_offset + g.cursor for g in active_groups for _ in g.row_list], device=device)
+
+            # (Active_Size, 4, Latents_Height, Latents_Width)
+            model_input = _take_rows(latents, active_rows)
+            active_latents = model_input
+
+            cfg_flags = [g.cfg_steps[g.cursor] for g in active_groups]
+            apply_cfg = any(cfg_flags)
+            if all(cfg_flags) and uniform_cfg_scale:
+                scale = cfg_scales[0]
+            else:
+                # (Active_Size, 1, 1, 1), a scale of 1 keeps only the conditional prediction
+                scale = [cfg_scales[i] if flag else 1.0 for g, flag in zip(active_groups, cfg_flags) for i in g.row_list]
+                scale = torch.tensor(scale, device=device, dtype=model_input.dtype).view(-1, 1, 1, 1)
+
+            unet_options = {}
+            if deep_cache_interval:
+                # Refresh the deep features every deep_cache_interval steps, reuse them in between
+                unet_options["reuse_deep_features"] = iteration % deep_cache_interval != 0
+                deep_cache_hits = diffusion.unet.deep_cache_hits
 
-            if do_cfg:
-                # (Batch_Size, 4, Latents_Height, Latents_Width) -> (2 * Batch_Size, 4, Latents_Height, Latents_Width)
+            if apply_cfg and cfg_mode == "sequential":
+                # Two passes of Batch_Size rows, the second one reuses the memory the first one freed
+                # (Batch_Size, 4, Latents_Height, Latents_Width)
+                output_cond = diffusion(model_input, cond_context, time_embedding, **unet_options)
+                # (Batch_Size, 4, Latents_Height, Latents_Width)
+                output_uncond = diffusion(model_input, uncond_context, time_embedding, **unet_options)
+                # cfg_scale * (output_cond - output_uncond) + output_uncond
+                model_output = output_uncond.lerp_(output_cond, scale)
+            elif apply_cfg:
+                # (Active_Size, 4, Latents_Height, Latents_Width) -> (2 * Active_Size, 4, Latents_Height, Latents_Width)
                 model_input = model_input.repeat(2, 1, 1, 1)
+                if len(time_embedding) > 1:
+                    # (Active_Size,) -> (2 * Active_Size,)
+                    time_embedding = time_embedding.repeat(2)
 
-            # model_output is the predicted noise
-            # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 4, Latents_Height, Latents_Width)
-            model_output = diffusion(model_input, context, time_embedding)
+                # model_output is the predicted noise
+                # (2 * Active_Size, 4, Latents_Height, Latents_Width) -> (2 * Active_Size, 4, Latents_Height, Latents_Width)
+                model_output = diffusion(model_input, full_context, time_embedding, **unet_options)
 
-            if do_cfg:
                 output_cond, output_uncond = model_output.chunk(2)
-                model_output = cfg_scale * (output_cond - output_uncond) + output_uncond
-
-            # Handle sampler step (DDIM-DSS returns tuple)
-            if sampler_name == "ddim-dss":
-                latents, next_t, skip_count = sampler.step(timestep, latents, model_output, prev_latents)
-                prev_latents = latents.clone()
-                sampler.timesteps = sampler.timesteps[sampler.current_step_idx:]
-                # Use initial n_inference_steps for progress reporting
-                if progress_callback:
-                    step_time = time.time() - step_start_time
-                    progress_callback(i, n_inference_steps, step_time)
-                    step_start_time = time.time()
-                if next_t == 0:
-                    break
+                model_output = scale * (output_cond - output_uncond) + output_uncond
             else:
-                latents = sampler.step(timestep, latents, model_output)
-                if progress_callback:
-                    step_time = time.time() - step_start_time
-                    progress_callback(i, len(sampler.timesteps), step_time)
-                    step_start_time = time.time()
+                # (Active_Size, 4, Latents_Height, Latents_Width) -> (Active_Size, 4, Latents_Height, Latents_Width)
+                model_output = diffusion(model_input, cond_context, time_embedding, **unet_options)
 
+            if deep_cache_interval:
+                unet_calls = 2 if apply_cfg and cfg_mode == "sequential" else 1
+                deep_cached_steps += (diffusion.unet.deep_cache_hits - deep_cache_hits) / unet_calls
+            # Each group steps its own rows of the shared UNet output
+            results = []
+            start = 0
+            for group in active_groups:
+                end = start + len(group.row_list)
+                if len(active_groups) == 1:
+                    group_latents, group_output = active_latents, model_output
+                else:
+                    group_latents, group_output = active_latents[start:end], model_output[start:end]
+                results.append(group.sampler.step(group.sampler.timesteps[group.cursor], group_latents, group_output))
+                start = end
+            latents = _put_rows(latents, active_rows, _cat_rows([r.prev_sample for r in results]))
+            group_pred_x0 = [g.sampler.pred_original_sample for g in active_groups]
+            if all(p is not None for p in group_pred_x0):
+                pred_x0 = _put_rows(pred_x0 if pred_x0 is not None else latents, active_rows, _cat_rows(group_pred_x0))
+            # One UNet call serves every group
+            nfe += max(r.nfe for r in results)
+
+            yield StepState(
+                step=step,
+                total_steps=total_steps,
+                timestep=timestep.item(),
+                latents=latents,
+                pred_x0=pred_x0,
+                nfe=nfe,
+            )
+
+            for group, result in zip(active_groups, results):
+                group.cursor += result.skip_count
+
+                group_x0 = group.sampler.pred_original_sample
+                if early_exit_tolerance is not None and group_x0 is not None:
+                    if group.prev_pred_x0 is not None and group.remaining > 0:
+                        # (Group_Size,) RMS change of each image's prediction, relative to its size
+                        change = torch.linalg.vector_norm((group_x0 - group.prev_pred_x0).flatten(1), dim=1)
+                        size = torch.linalg.vector_norm(group_x0.flatten(1), dim=1)
+                        if bool((change <= early_exit_tolerance * size).all()):
+                            # One UNet call per remaining schedule entry (ddim-dss strides may have needed fewer)
+                            group.skipped_nfe = group.remaining
+                            group.cursor = len(group.sampler.timesteps)
+                            latents = _put_rows(latents, group.rows, group_x0)
+                    group.prev_pred_x0 = group_x0
+
+            remaining = max(g.remaining for g in groups)
+            progress.update(total_steps - remaining - step)
+            iteration += 1
+    finally:
+        progress.close()
+        # Release the cached projections and time embeddings, also when the caller stops early
+        set_kv_cache(diffusion, False)
+        diffusion.clear_time_table()
+        if deep_cache_interval:
+            deep_cache_savings = diffusion.deep_cache_savings(latents_height, latents_width) or 0.0
+            diffusion.clear_deep_cache()
+        if token_merge_ratio:
+            diffusion.set_token_merging(None)
+        if plan_skip_buffers:
+            # The guided and the conditional-only batches each get a plan, the larger one sets the peak
+            skip_plan_stats = max(diffusion.skip_plan_stats().values(), key=lambda stats: stats["unplanned_peak_bytes"], default=None)
+            diffusion.set_skip_planning(False)
         to_idle(diffusion)
 
-        decoder = models["decoder"]
-        decoder.to(device)
-        # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Height, Width)
-        images = decoder(latents)
-        to_idle(decoder)
-
-        images = rescale(images, (-1, 1), (0, 255), clamp=True)
-        # (Batch_Size, Channel, Height, Width) -> (Batch_Size, Height, Width, Channel)
-        images = images.permute(0, 2, 3, 1)
-        images = images.to("cpu", torch.uint8).numpy()
-        return images[0]
- 
+    cancel_token.raise_if_cancelled()
+    decoder = models["decoder"]
+    decoder.to(device)
+    # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Height, Width)
+    if vae_tile_size:
+        images = tiled_decode(decoder, latents, vae_tile_size, vae_tile_overlap)
+    else:
+        # The decoder divides its input in place, and the latents were already yielded
+        images = decoder(latents.clone())
+    to_idle(decoder)
+
+    images = rescale(images, (-1, 1), (0, 255), clamp=True)
+    # (Batch_Size, Channel, Height, Width) -> (Batch_Size, Height, Width, Channel)
+    images = images.permute(0, 2, 3, 1)
+    images = images.to("cpu", torch.uint8).numpy()
+    if not is_batch:
+        # (Batch_Size, Height, Width, Channel) -> (Height, Width, Channel)
+        images = images[0]
+
+    yield StepState(
+        step=total_steps - 1,
+        total_steps=total_steps,
+        timestep=timestep.item(),
+        latents=latents,
+        pred_x0=pred_x0,
+        nfe=nfe,
+        images=images,
+        skipped_nfe=max(g.skipped_nfe for g in groups),
+        deep_cache_saved_nfe=deep_cached_steps * deep_cache_savings if deep_cache_interval else 0.0,
+        skip_plan_stats=skip_plan_stats if plan_skip_buffers else None,
+    )
+
+def encode_prompts(prompts, clip, tokenizer, device, to_idle=lambda x: x, prompt_cache=None):
+    # Convert into a list of length Seq_Len=77
+    token_ids = tokenizer.batch_encode_plus(
+        prompts, padding="max_length", max_length=77
+    ).input_ids
+
+    # The text encoder is only moved to the device when some prompt is not cached yet
+    if prompt_cache is not None and prompt_cache.contains_all(token_ids):
+        return prompt_cache.encode(None, token_ids, device)
+
+    clip.to(device)
+    if prompt_cache is not None:
+        # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
+        context = prompt_cache.encode(clip, token_ids, device)
+    else:
+        # (Batch_Size, Seq_Len)
+        tokens = torch.tensor(token_ids, dtype=torch.long, device=device)
+        # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
+        context = clip(tokens)
+    to_idle(clip)
+    return context
+
+def _expand_to_batch(value, batch_size, name):
+    # Broadcast a single value to the batch, or check that a list matches it
+    if isinstance(value, (list, tuple)):
+        if len(value) != batch_size:
+            raise ValueError(f"{name} has {len(value)} entries but {batch_size} prompts were given")
+        return list(value)
+    return [value] * batch_size
+
+def _take_rows(x, rows):
+    # Rows of a group, or the whole batch when rows is None
+    return x if rows is None else x[rows]
+
+def _put_rows(x, rows, value):
+    # Copy of x with the rows of a group replaced, value itself when the group is the whole batch
+    return value if rows is None else x.index_copy(0, rows, value)
+
+def _cat_rows(tensors):
+    return tensors[0] if len(tensors) == 1 else torch.cat(tensors)
+
 def rescale(x, old_range, new_range, clamp=False):
     old_min, old_max = old_range
     new_min, new_max = new_range
@@ -189,10 +521,14 @@ def rescale(x, old_range, new_range, clamp=False):
         x = x.clamp(new_min, new_max)
     return x
 
+# Shape: (160,)
+_TIME_FREQS = torch.pow(10000, -torch.arange(start=0, end=160, dtype=torch.float32) / 160)
+
 def get_time_embedding(timestep):
-    # Shape: (160,)
-    freqs = torch.pow(10000, -torch.arange(start=0, end=160, dtype=torch.float32) / 160) 
-    # Shape: (1, 160)
-    x = torch.tensor([timestep], dtype=torch.float32)[:, None] * freqs[None]
-    # Shape: (1, 160 * 2)
+    # Accepts a single timestep or a 1-D sequence of timesteps
+    # Shape: (N,)
+    timesteps = torch.as_tensor(timestep, dtype=torch.float32).reshape(-1)
+    # Shape: (N, 160)
+    x = timesteps[:, None] * _TIME_FREQS[None]
+    # Shape: (N, 160 * 2)
     return torch.cat([torch.cos(x), torch.sin(x)], dim=-1)
\ No newline at end of file
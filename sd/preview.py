@@ -0,0 +1,35 @@
+import torch
+from torch.nn import functional as F
+
+# Linear approximation of the VAE decoder for Stable Diffusion 1.x latents, one RGB row per latent channel
+LATENT_RGB_FACTORS = [
+    #   R       G       B
+    [ 0.3512,  0.2297,  0.3227],
+    [ 0.3250,  0.4974,  0.2350],
+    [-0.2829,  0.1762,  0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+def latents_to_rgb(latents, scale_factor=8):
+    """
+    Cheap preview of latents as RGB images, without running the VAE decoder.
+
+    Args:
+        latents (torch.Tensor): Latents, or the predicted x0, of shape (Batch_Size, 4, Latents_Height, Latents_Width).
+        scale_factor (int): Upsampling factor, 8 gives the size of the decoded image.
+
+    Returns:
+        numpy.ndarray: uint8 images of shape (Batch_Size, Latents_Height * scale_factor, Latents_Width * scale_factor, 3).
+    """
+    with torch.no_grad():
+        factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+        # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Latents_Height, Latents_Width)
+        images = torch.einsum("bchw,cr->brhw", latents, factors)
+        if scale_factor != 1:
+            # (Batch_Size, 3, Latents_Height, Latents_Width) -> (Batch_Size, 3, Height, Width)
+            images = F.interpolate(images, scale_factor=scale_factor, mode="bilinear", align_corners=False)
+        # (-1, 1) -> (0, 255)
+        images = ((images + 1) * 127.5).clamp(0, 255)
+        # (Batch_Size, 3, Height, Width) -> (Batch_Size, Height, Width, 3)
+        images = images.permute(0, 2, 3, 1)
+        return images.to("cpu", torch.uint8).numpy()
@@ -0,0 +1,135 @@
+import hashlib
+import os
+from collections import OrderedDict
+import torch
+
+class PromptEmbeddingCache:
+    def __init__(self, namespace="", max_entries=64, cache_dir=None, max_disk_bytes=256 * 1024 * 1024):
+        """
+        Content-addressed cache of CLIP context embeddings, keyed by the prompt's token ids.
+
+        Args:
+            namespace (str): Identifies the text encoder weights, so embeddings of different checkpoints never mix.
+            max_entries (int): Number of embeddings kept in memory, least recently used are dropped first.
+            cache_dir (str, optional): Directory for the on-disk store. None keeps the cache in memory only.
+            max_disk_bytes (int): Size limit of the on-disk store, least recently used files are evicted first.
+        """
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, token_ids):
+        ids = ",".join(str(int(i)) for i in token_ids)
+        return hashlib.sha1(f"{self.namespace}|{ids}".encode("utf-8")).hexdigest()
+
+    def get(self, token_ids):
+        key = self.key(token_ids)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                embedding = torch.load(path, map_location="cpu", weights_only=True)
+            except Exception:
+                # A truncated or stale file is treated as a miss and rewritten on the next put
+                return None
+            # Refresh the modification time so disk eviction is least recently used
+            os.utime(path)
+            self._remember(key, embedding)
+            return embedding
+        return None
+
+    def put(self, token_ids, embedding):
+        # (Seq_Len, Dim), copied so a row of a batched output does not keep the whole batch alive
+        embedding = embedding.detach().clone()
+        key = self.key(token_ids)
+        self._remember(key, embedding)
+
+        path = self._path(key)
+        if path is not None:
+            torch.save(embedding.to("cpu"), path)
+            self._evict_disk()
+
+    def contains_all(self, token_ids_list):
+        return all(self.get(token_ids) is not None for token_ids in token_ids_list)
+
+    def encode(self, clip, token_ids_list, device=None):
+        """
+        Return the context of every prompt, running the text encoder only on the prompts that are not cached.
+        Identical prompts in the same call are encoded once.
+
+        Args:
+            clip (sd.clip.CLIP): Text encoder, already on `device` if anything has to be encoded.
+            token_ids_list (list[list[int]]): Token ids of each prompt, padded to Seq_Len=77.
+            device: Device of the returned context.
+
+        Returns:
+            torch.Tensor: Context of shape (Batch_Size, Seq_Len, Dim).
+        """
+        embeddings = [self.get(token_ids) for token_ids in token_ids_list]
+
+        missing = OrderedDict()
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(self.key(token_ids_list[i]), []).append(i)
+
+        if missing:
+            rows = [token_ids_list[indices[0]] for indices in missing.values()]
+            # (Missing, Seq_Len)
+            tokens = torch.tensor(rows, dtype=torch.long, device=device)
+            # (Missing, Seq_Len) -> (Missing, Seq_Len, Dim)
+            encoded = clip(tokens)
+            for row, indices, embedding in zip(rows, missing.values(), encoded):
+                self.put(row, embedding)
+                for i in indices:
+                    embeddings[i] = embedding
+
+        # (Batch_Size, Seq_Len, Dim)
+        return torch.stack([embedding.to(device) for embedding in embeddings])
+
+    def precompute(self, clip, tokenizer, prompts=("",), device=None):
+        """Encode prompts ahead of time, typically the empty negative prompt right after loading a checkpoint."""
+        token_ids_list = tokenizer.batch_encode_plus(
+            list(prompts), padding="max_length", max_length=77
+        ).input_ids
+        if self.contains_all(token_ids_list):
+            return
+        with torch.no_grad():
+            self.encode(clip, token_ids_list, device)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _remember(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pt"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total_size -= size
@@ -0,0 +1,39 @@
+from collections import namedtuple
+from functools import partial
+from sd.ddpm import DDPMSampler
+from sd.ddim import DDIMSampler
+from sd.ddim_dss import DDIMDSSSampler
+from sd.dpm_solver import DPMSolverMultistepSampler
+from sd.euler import EulerSampler
+from sd.heun import HeunSampler
+from sd.unipc import UniPCMultistepSampler
+
+SamplerSpec = namedtuple("SamplerSpec", ["label", "factory"])
+
+# Sampler name -> (label shown in the UI, factory(generator) building the sampler), in display order
+SAMPLERS = {}
+
+def register_sampler(name, label, factory):
+    """
+    Make a sampler selectable by name in the pipeline and by label in the UI.
+    factory(generator) must accept a torch.Generator or a list with one per row of the batch, and return an object with set_inference_timesteps, set_strength, add_noise,
+    a timesteps tensor, pred_original_sample, and a step(timestep, latents, model_output) returning a StepResult.
+    """
+    SAMPLERS[name] = SamplerSpec(label, factory)
+
+def get_sampler(name, generator, n_inference_steps=50, **options):
+    if name not in SAMPLERS:
+        names = ", ".join(f"'{n}'" for n in SAMPLERS)
+        raise ValueError(f"Unknown sampler value '{name}'. Use one of {names}.")
+    sampler = SAMPLERS[name].factory(generator, **options)
+    sampler.set_inference_timesteps(n_inference_steps)
+    return sampler
+
+register_sampler("ddpm", "DDPM", DDPMSampler)
+register_sampler("ddim", "DDIM", DDIMSampler)
+register_sampler("ddim-dss", "DDIM - Dynamic Step Skipping", DDIMDSSSampler)
+register_sampler("dpm++2m", "DPM++ 2M", DPMSolverMultistepSampler)
+register_sampler("euler", "Euler", EulerSampler)
+register_sampler("euler-a", "Euler Ancestral", partial(EulerSampler, ancestral=True))
+register_sampler("heun", "Heun", HeunSampler)
+register_sampler("unipc", "UniPC", UniPCMultistepSampler)
@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+TIMESTEP_SPACINGS = ("leading", "trailing", "linspace", "karras")
+
+def make_timesteps(spacing, num_inference_steps, alphas_cumprod, rho=7.0):
+    """
+    Descending inference timesteps, shared by all samplers.
+
+    Args:
+        spacing (str): One of TIMESTEP_SPACINGS:
+            "leading": 0, r, 2r, ... with r = num_train_timesteps // num_inference_steps, ends at t = 0.
+            "trailing": starts at the last training timestep and goes down by num_train_timesteps / num_inference_steps,
+                so the first step sees pure noise (https://arxiv.org/abs/2305.08891).
+            "linspace": evenly spaced from the last training timestep down to 0.
+            "karras": noise levels spaced as in https://arxiv.org/abs/2206.00364, which gives fractional timesteps.
+        num_inference_steps (int): Number of timesteps.
+        alphas_cumprod (torch.Tensor): (Num_Train_Timesteps,) cumulative alphas of the training noise schedule.
+        rho (float): Karras spacing exponent, larger values put more steps at low noise.
+
+    Returns:
+        torch.Tensor: (num_inference_steps,) int64 timesteps, or float64 for "karras".
+    """
+    num_train_timesteps = len(alphas_cumprod)
+    if spacing == "leading":
+        step_ratio = num_train_timesteps // num_inference_steps
+        timesteps = (torch.arange(num_inference_steps) * step_ratio).flip(0)
+    elif spacing == "trailing":
+        # From an integer count, a float step in np.arange can add a point past the end, at timestep -1
+        steps = np.arange(num_inference_steps, 0, -1)
+        timesteps = torch.from_numpy(np.round(steps * num_train_timesteps / num_inference_steps).astype(np.int64) - 1)
+    elif spacing == "linspace":
+        timesteps = np.linspace(0, num_train_timesteps - 1, num_inference_steps).round()[::-1]
+        timesteps = torch.from_numpy(timesteps.copy().astype(np.int64))
+    elif spacing == "karras":
+        log_sigmas = _log_sigmas(alphas_cumprod).numpy()
+        sigma_min, sigma_max = np.exp(log_sigmas[0]), np.exp(log_sigmas[-1])
+        ramp = np.linspace(0, 1, num_inference_steps)
+        min_inv_rho = sigma_min ** (1 / rho)
+        max_inv_rho = sigma_max ** (1 / rho)
+        sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+        # Noise level -> fractional timestep, linear in log sigma between training timesteps
+        timesteps = torch.from_numpy(np.interp(np.log(sigmas), log_sigmas, np.arange(num_train_timesteps)))
+    else:
+        raise ValueError(f"Unknown timestep spacing '{spacing}'. Use one of {', '.join(TIMESTEP_SPACINGS)}.")
+
+    # A negative timestep would index alphas_cumprod from the end, at the pure noise level
+    if len(timesteps) != num_inference_steps or timesteps.min() < 0 or timesteps.max() > num_train_timesteps - 1:
+        raise RuntimeError(f"'{spacing}' spacing made an invalid schedule for {num_inference_steps} steps")
+    return timesteps
+
+def alphas_cumprod_at(alphas_cumprod, timesteps):
+    """
+    alpha_cumprod at the given timesteps. Fractional timesteps are interpolated linearly in log sigma,
+    the inverse of the "karras" spacing, and return float64.
+    """
+    timesteps = torch.as_tensor(timesteps)
+    if not torch.is_floating_point(timesteps):
+        return alphas_cumprod[timesteps]
+    log_sigmas = _log_sigmas(alphas_cumprod)
+    timesteps = timesteps.double().clamp(0, len(alphas_cumprod) - 1)
+    low = timesteps.floor().long().clamp(max=len(alphas_cumprod) - 2)
+    weight = timesteps - low
+    log_sigma = (1 - weight) * log_sigmas[low] + weight * log_sigmas[low + 1]
+    # sigma^2 = (1 - alpha_cumprod) / alpha_cumprod
+    return 1 / (1 + torch.exp(2 * log_sigma))
+
+def _log_sigmas(alphas_cumprod):
+    alphas_cumprod = alphas_cumprod.double()
+    return (((1 - alphas_cumprod) / alphas_cumprod).sqrt()).log()
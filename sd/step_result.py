@@ -0,0 +1,8 @@
+from collections import namedtuple
+
+# Returned by every sampler's step:
+#   prev_sample: (Batch_Size, 4, Latents_Height, Latents_Width) latents to run the next step on
+#   next_timestep: timestep of the next step, None after the last one
+#   skip_count: number of entries of sampler.timesteps the cursor moves forward, more than 1 when steps are skipped
+#   nfe: UNet evaluations spent on this step
+StepResult = namedtuple("StepResult", ["prev_sample", "next_timestep", "skip_count", "nfe"], defaults=[1, 1])
@@ -0,0 +1,81 @@
+import torch
+
+def bipartite_soft_matching(x, height, width, ratio, stride=2):
+    """
+    Token merging for Stable Diffusion (https://arxiv.org/abs/2303.17604).
+
+    The tokens are split into destinations, the top left token of every stride x stride cell, and sources, all others.
+    The ratio * Seq_Len sources that are most similar to a destination (cosine similarity) are averaged into it.
+
+    Args:
+        x (torch.Tensor): (Batch_Size, Height * Width, Features) tokens the matching is computed on.
+        height (int), width (int): Token grid of x.
+        ratio (float): Fraction of all tokens to remove, at most the share of sources (3/4 with stride 2).
+        stride (int): Size of the cells that hold one destination each.
+
+    Returns:
+        (merge, unmerge): merge maps (Batch_Size, Height * Width, Dim) tokens to (Batch_Size, Seq_Len_Merged, Dim),
+        unmerge maps them back, every merged source gets the value of its destination.
+    """
+    batch_size, seq_len, _ = x.shape
+    cells_h, cells_w = height // stride, width // stride
+    num_dst = cells_h * cells_w
+    r = min(int(seq_len * ratio), seq_len - num_dst)
+    if r <= 0:
+        return _identity, _identity
+
+    with torch.no_grad():
+        # (Height, Width): -1 for the destination of every cell, 0 for the sources
+        is_dst = torch.zeros(height, width, dtype=torch.long, device=x.device)
+        is_dst[:cells_h * stride:stride, :cells_w * stride:stride] = -1
+        # (1, Seq_Len, 1) token indices, destinations first
+        order = is_dst.view(1, -1, 1).argsort(dim=1, stable=True)
+        # (1, Num_Dst, 1), (1, Num_Src, 1)
+        dst_idx, src_idx = order[:, :num_dst], order[:, num_dst:]
+
+        # (Batch_Size, Seq_Len, Features)
+        metric = x / x.norm(dim=-1, keepdim=True)
+        src = metric.gather(1, src_idx.expand(batch_size, -1, metric.shape[-1]))
+        dst = metric.gather(1, dst_idx.expand(batch_size, -1, metric.shape[-1]))
+        # (Batch_Size, Num_Src, Num_Dst)
+        scores = src @ dst.transpose(-1, -2)
+
+        # Best destination of every source, and the sources ordered from most to least similar
+        # (Batch_Size, Num_Src)
+        best_score, best_dst = scores.max(dim=-1)
+        # (Batch_Size, Num_Src, 1)
+        by_score = best_score.argsort(dim=-1, descending=True)[..., None]
+        # (Batch_Size, Num_Src - r, 1) sources that are kept, (Batch_Size, r, 1) sources that are merged
+        kept, merged = by_score[:, r:], by_score[:, :r]
+        # (Batch_Size, r, 1) destination of every merged source
+        merged_dst = best_dst[..., None].gather(1, merged)
+
+        # Positions in the full sequence of the kept and the merged sources
+        # (Batch_Size, Num_Src - r, 1), (Batch_Size, r, 1)
+        kept_pos = src_idx.expand(batch_size, -1, -1).gather(1, kept)
+        merged_pos = src_idx.expand(batch_size, -1, -1).gather(1, merged)
+
+    def merge(tokens):
+        # (Batch_Size, Seq_Len, Dim) -> (Batch_Size, Num_Src - r + Num_Dst, Dim)
+        dim = tokens.shape[-1]
+        dst_tokens = tokens.gather(1, dst_idx.expand(batch_size, -1, dim))
+        merged_tokens = tokens.gather(1, merged_pos.expand(-1, -1, dim))
+        # Mean of every destination and the sources merged into it
+        dst_tokens = dst_tokens.scatter_reduce(1, merged_dst.expand(-1, -1, dim), merged_tokens, reduce="mean")
+        kept_tokens = tokens.gather(1, kept_pos.expand(-1, -1, dim))
+        return torch.cat([kept_tokens, dst_tokens], dim=1)
+
+    def unmerge(tokens):
+        # (Batch_Size, Num_Src - r + Num_Dst, Dim) -> (Batch_Size, Seq_Len, Dim)
+        dim = tokens.shape[-1]
+        kept_tokens, dst_tokens = tokens[:, :seq_len - num_dst - r], tokens[:, seq_len - num_dst - r:]
+        out = tokens.new_empty(batch_size, seq_len, dim)
+        out.scatter_(1, dst_idx.expand(batch_size, -1, dim), dst_tokens)
+        out.scatter_(1, kept_pos.expand(-1, -1, dim), kept_tokens)
+        out.scatter_(1, merged_pos.expand(-1, -1, dim), dst_tokens.gather(1, merged_dst.expand(-1, -1, dim)))
+        return out
+
+    return merge, unmerge
+
+def _identity(tokens):
+    return tokens
@@ -0,0 +1,102 @@
+import math
+import torch
+from sd.step_result import StepResult
+from sd.spacing import alphas_cumprod_at
+from sd.noise_schedule import NoiseScheduleSampler
+
+class UniPCMultistepSampler(NoiseScheduleSampler):
+    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start=0.00085, beta_end=0.0120, solver_order=2, timestep_spacing="leading"):
+        """
+        UniPC: multistep predictor (UniP) with a corrector (UniC) in data (x0) prediction form, B(h) = e^h - 1 variant,
+        see https://arxiv.org/abs/2302.04867. The corrector reuses the UNet output of the next step, so it costs no extra UNet call.
+        """
+        if solver_order not in (1, 2):
+            raise ValueError("solver_order must be 1 or 2")
+        super().__init__(generator, num_training_steps, beta_start, beta_end, timestep_spacing)
+        self.solver_order = solver_order
+
+        self.set_inference_timesteps(50)
+
+    def _set_schedule(self):
+        # alpha_cumprod of every timestep, followed by 1.0 for the fully denoised end point
+        alphas_cumprod = torch.cat([alphas_cumprod_at(self.alphas_cumprod, self.timesteps).double(), torch.ones(1).double()])
+        # Signal and noise scales of x_t = alpha_t * x_0 + sigma_t * noise, and lambda_t = log(alpha_t / sigma_t)
+        self._alpha_t = alphas_cumprod.sqrt().tolist()
+        self._sigma_t = (1 - alphas_cumprod).sqrt().tolist()
+        self._lambda_t = [math.log(a / s) if s > 0 else float("inf") for a, s in zip(self._alpha_t, self._sigma_t)]
+        self._step_index = 0
+        # x0 predictions of the latest steps, oldest first
+        self._x0_history = []
+        # Sample and order of the last predictor step, to be corrected once the next UNet output is known
+        self._last_sample = None
+        self._last_order = None
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        i = self._step_index
+
+        # Data prediction from the predicted noise, at the uncorrected latents the UNet has seen
+        pred_x0 = (latents - self._sigma_t[i] * model_output) / self._alpha_t[i]
+        self.pred_original_sample = pred_x0
+
+        if i + 1 == len(self.timesteps):
+            # The last step lands on the fully denoised latents, first order is used there for stability
+            x_prev = pred_x0
+        else:
+            if self._last_sample is not None:
+                latents = self._correct(i, pred_x0)
+            self._x0_history = (self._x0_history + [pred_x0])[-self.solver_order:]
+            order = min(self.solver_order, len(self._x0_history))
+            x_prev = self._predict(i, latents, order)
+            self._last_sample = latents
+            self._last_order = order
+
+        self._step_index += 1
+        return StepResult(x_prev, self._next_timestep())
+
+    def _coefficients(self, h, order):
+        # B(h) and the right-hand side b of the order conditions, with hh = -h for data prediction
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        B_h = h_phi_1
+        h_phi_k = h_phi_1 / hh - 1
+        factorial = 1
+        b = []
+        for k in range(1, order + 1):
+            b.append(h_phi_k * factorial / B_h)
+            factorial *= k + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial
+        return h_phi_1, B_h, b
+
+    def _predict(self, i, latents, order):
+        # UniP: step from timestep i to i + 1
+        m0 = self._x0_history[-1]
+        h = self._lambda_t[i + 1] - self._lambda_t[i]
+        h_phi_1, B_h, _ = self._coefficients(h, order)
+
+        x_t = (self._sigma_t[i + 1] / self._sigma_t[i]) * latents - self._alpha_t[i + 1] * h_phi_1 * m0
+        if order == 2:
+            m1 = self._x0_history[-2]
+            r1 = (self._lambda_t[i - 1] - self._lambda_t[i]) / h
+            D1 = (m1 - m0) / r1
+            x_t = x_t - self._alpha_t[i + 1] * B_h * 0.5 * D1
+        return x_t
+
+    def _correct(self, i, model_t):
+        # UniC: redo the step from timestep i - 1 to i with the x0 prediction at i
+        order = self._last_order
+        m0 = self._x0_history[-1]
+        h = self._lambda_t[i] - self._lambda_t[i - 1]
+        h_phi_1, B_h, b = self._coefficients(h, order)
+
+        x_t = (self._sigma_t[i] / self._sigma_t[i - 1]) * self._last_sample - self._alpha_t[i] * h_phi_1 * m0
+        D1_t = model_t - m0
+        if order == 1:
+            return x_t - self._alpha_t[i] * B_h * 0.5 * D1_t
+
+        m1 = self._x0_history[-2]
+        r1 = (self._lambda_t[i - 2] - self._lambda_t[i - 1]) / h
+        D1 = (m1 - m0) / r1
+        # Solve [[1, 1], [r1, 1]] @ rhos = b
+        rho_0 = (b[0] - b[1]) / (1 - r1)
+        rho_1 = b[0] - rho_0
+        return x_t - self._alpha_t[i] * B_h * (rho_0 * D1 + rho_1 * D1_t)
@@ -0,0 +1,113 @@
+import torch
+
+# The VAE maps one latent pixel to an 8x8 block of image pixels
+VAE_SCALE_FACTOR = 8
+
+def tiled_decode(decoder, latents, tile_size=32, overlap=8):
+    """
+    Decode latents tile by tile, so peak memory depends on the tile size instead of the image size.
+    Overlapping tiles are blended with linear ramps to hide the seams.
+
+    Args:
+        decoder (sd.decoder.VAE_Decoder): The VAE decoder.
+        latents (torch.Tensor): Latents of shape (Batch_Size, 4, Latents_Height, Latents_Width).
+        tile_size (int): Tile edge in latent pixels.
+        overlap (int): Overlap between neighbouring tiles in latent pixels.
+
+    Returns:
+        torch.Tensor: Images of shape (Batch_Size, 3, Height, Width).
+    """
+    batch_size, _, latents_height, latents_width = latents.shape
+    if latents_height <= tile_size and latents_width <= tile_size:
+        # The decoder divides its input in place
+        return decoder(latents.clone())
+
+    # (Batch_Size, 3, Height, Width)
+    output = None
+    # (1, 1, Height, Width)
+    weights = torch.zeros(
+        (1, 1, latents_height * VAE_SCALE_FACTOR, latents_width * VAE_SCALE_FACTOR),
+        dtype=latents.dtype, device=latents.device
+    )
+    for y0, y1 in _tile_ranges(latents_height, tile_size, overlap):
+        for x0, x1 in _tile_ranges(latents_width, tile_size, overlap):
+            # (Batch_Size, 4, Tile_Height, Tile_Width) -> (Batch_Size, 3, Tile_Height * 8, Tile_Width * 8)
+            tile = decoder(latents[:, :, y0:y1, x0:x1].clone())
+            if output is None:
+                output = torch.zeros(
+                    (batch_size, tile.shape[1]) + weights.shape[2:], dtype=tile.dtype, device=tile.device
+                )
+            # (1, 1, Tile_Height * 8, Tile_Width * 8)
+            mask = _blend_mask(
+                (y0, y1), (x0, x1), (latents_height, latents_width), overlap, VAE_SCALE_FACTOR, tile
+            )
+            region = (slice(None), slice(None), slice(y0 * VAE_SCALE_FACTOR, y1 * VAE_SCALE_FACTOR), slice(x0 * VAE_SCALE_FACTOR, x1 * VAE_SCALE_FACTOR))
+            output[region] += tile * mask
+            weights[region] += mask
+
+    return output / weights
+
+def tiled_encode(encoder, images, noise, tile_size=32, overlap=8):
+    """
+    Encode images tile by tile, the counterpart of tiled_decode.
+
+    Args:
+        encoder (sd.encoder.VAE_Encoder): The VAE encoder.
+        images (torch.Tensor): Images of shape (Batch_Size, 3, Height, Width), Height and Width multiples of 8.
+        noise (torch.Tensor): Noise of shape (Batch_Size, 4, Height / 8, Width / 8).
+        tile_size (int): Tile edge in latent pixels.
+        overlap (int): Overlap between neighbouring tiles in latent pixels.
+
+    Returns:
+        torch.Tensor: Latents of shape (Batch_Size, 4, Height / 8, Width / 8).
+    """
+    _, _, latents_height, latents_width = noise.shape
+    if latents_height <= tile_size and latents_width <= tile_size:
+        return encoder(images, noise)
+
+    # (Batch_Size, 4, Latents_Height, Latents_Width)
+    output = torch.zeros_like(noise)
+    # (1, 1, Latents_Height, Latents_Width)
+    weights = torch.zeros((1, 1, latents_height, latents_width), dtype=noise.dtype, device=noise.device)
+    for y0, y1 in _tile_ranges(latents_height, tile_size, overlap):
+        for x0, x1 in _tile_ranges(latents_width, tile_size, overlap):
+            # (Batch_Size, 3, Tile_Height * 8, Tile_Width * 8) -> (Batch_Size, 4, Tile_Height, Tile_Width)
+            tile = encoder(
+                images[:, :, y0 * VAE_SCALE_FACTOR:y1 * VAE_SCALE_FACTOR, x0 * VAE_SCALE_FACTOR:x1 * VAE_SCALE_FACTOR],
+                noise[:, :, y0:y1, x0:x1],
+            )
+            # (1, 1, Tile_Height, Tile_Width)
+            mask = _blend_mask((y0, y1), (x0, x1), (latents_height, latents_width), overlap, 1, tile)
+            output[:, :, y0:y1, x0:x1] += tile * mask
+            weights[:, :, y0:y1, x0:x1] += mask
+
+    return output / weights
+
+def _tile_ranges(length, tile_size, overlap):
+    # Start and end of every tile along one axis, the last tile is aligned with the end
+    if length <= tile_size:
+        return [(0, length)]
+    stride = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size, stride)) + [length - tile_size]
+    return [(start, start + tile_size) for start in starts]
+
+def _blend_mask(y_range, x_range, size, overlap, scale, like):
+    # Linear ramps over the overlap on every edge that borders another tile, 1 elsewhere
+    ramp_y = _ramp(y_range, size[0], overlap, scale, like)
+    ramp_x = _ramp(x_range, size[1], overlap, scale, like)
+    # (1, 1, Tile_Height * Scale, Tile_Width * Scale)
+    return (ramp_y[:, None] * ramp_x[None, :])[None, None]
+
+def _ramp(tile_range, length, overlap, scale, like):
+    start, end = tile_range
+    n = (end - start) * scale
+    width = overlap * scale
+    ramp = torch.ones(n, dtype=like.dtype, device=like.device)
+    if width <= 0:
+        return ramp
+    positions = torch.arange(n, dtype=like.dtype, device=like.device) + 0.5
+    if start > 0:
+        ramp = torch.minimum(ramp, positions / width)
+    if end < length:
+        ramp = torch.minimum(ramp, (n - positions) / width)
+    return ramp
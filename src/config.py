@@ -4,6 +4,7 @@ from PyQt5.QtGui import QFont
 BUTTON_ACTIVE_COLOR = "#2776EA"
 BUTTON_INACTIVE_COLOR = "#4D495B"
 GENERATE_BUTTON_COLOR = "#01D449"
+CANCEL_BUTTON_COLOR = "#E5484D"
 DOWNLOAD_BUTTON_COLOR = "#2776EA"
 PARAMS_CHECKED_COLOR = "#4D495B"
 
@@ -58,4 +59,7 @@ DEFAULT_PARAMETERS = {
         "INFERENCE_STEPS": 75
     }
 }
-DEFAULT_SEED = 42
\ No newline at end of file
+DEFAULT_SEED = 42
+# Output size in pixels, multiples of 64
+DEFAULT_WIDTH = 512
+DEFAULT_HEIGHT = 512
\ No newline at end of file
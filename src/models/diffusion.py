@@ -1,24 +1,29 @@
-from typing import Callable
+from typing import Callable, List, Union
 from PIL import Image
 import numpy as np
 from sd.demo import generate_image
+from sd.cancellation import CancellationToken, GenerationCancelled
 
 class DiffusionModel:
     @staticmethod
     def process(
         image_path: str,
-        sentence: str,
-        uncond_prompt: str,
+        sentence: Union[str, List[str]],
+        uncond_prompt: Union[str, List[str]],
         strength: float,
         do_cfg: bool,
         cfg_scale: float,
         sampler: str,
         num_inference_steps: int,
-        seed: int,
-        progress_callback: Callable[[int, int, float], None] = None
+        seed: Union[int, List[int]],
+        progress_callback: Callable[[int, int, float], None] = None,
+        width: int = 512,
+        height: int = 512,
+        cancel_token: CancellationToken = None
     ) -> np.ndarray:
         """
         Process an image with the diffusion model.
+        A list of sentences is generated as one batch and returns one image per sentence.
         """
         try:
             input_image = Image.open(image_path).convert("RGB") if image_path else None
@@ -32,8 +37,13 @@ class DiffusionModel:
                 sampler=sampler,
                 num_inference_steps=num_inference_steps,
                 seed=seed,
-                progress_callback=progress_callback
+                progress_callback=progress_callback,
+                width=width,
+                height=height,
+                cancel_token=cancel_token
             )
             return output_image
+        except GenerationCancelled:
+            raise
         except Exception as e:
             raise RuntimeError(f"Diffusion model failed: {str(e)}")
\ No newline at end of file
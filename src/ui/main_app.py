@@ -14,6 +14,7 @@ from ui.dialogs import FullScreenImageDialog
 from workers.processing import Worker
 from utils.image_utils import numpy_to_pixmap, validate_image_path
 from utils.setup import SetupManager
+from sd.samplers import SAMPLERS
 from config import *
 
 class SetupDialog(QDialog):
@@ -119,6 +120,7 @@ class ImageApp(QMainWindow):
         self.output_image = None
         self._gradient_color = QColor("#222222")
         self.current_mode = DEFAULT_MODE  # Set to Text-to-Image
+        self.processing = False
         self.resize(1280, 720)
         self.setMinimumSize(0, 0)
         project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
@@ -241,7 +243,9 @@ class ImageApp(QMainWindow):
         sampler_layout.addWidget(self.sampler_label)
         self.sampler_dropdown = QComboBox()
         self.sampler_dropdown.setFont(LARGE_FONT)
-        self.sampler_dropdown.addItems(["DDPM", "DDIM", "DDIM - Dynamic Step Skipping"])
+        # Item text is the sampler's label, item data its pipeline name
+        for name, spec in SAMPLERS.items():
+            self.sampler_dropdown.addItem(spec.label, name)
         self.sampler_dropdown.setStyleSheet("""
             QComboBox {
                 padding: 15px;
@@ -330,6 +334,27 @@ class ImageApp(QMainWindow):
         steps_widget.setLayout(steps_layout)
         params_layout.addWidget(steps_widget)
 
+        size_widget = QWidget()
+        size_widget.setStyleSheet(LAYOUT_STYLE)
+        size_layout = QHBoxLayout()
+        self.size_label = QLabel("Size (W x H):")
+        self.size_label.setFont(LARGE_FONT)
+        self.size_label.setStyleSheet(SIMPLE_LABEL_STYLE)
+        size_layout.addWidget(self.size_label)
+        self.width_input = QLineEdit(str(DEFAULT_WIDTH))
+        self.width_input.setFont(LARGE_FONT)
+        self.width_input.setStyleSheet(SIMPLE_INPUT_STYLE)
+        self.width_input.setFixedWidth(100)
+        size_layout.addWidget(self.width_input)
+        self.height_input = QLineEdit(str(DEFAULT_HEIGHT))
+        self.height_input.setFont(LARGE_FONT)
+        self.height_input.setStyleSheet(SIMPLE_INPUT_STYLE)
+        self.height_input.setFixedWidth(100)
+        size_layout.addWidget(self.height_input)
+        size_layout.addStretch()
+        size_widget.setLayout(size_layout)
+        params_layout.addWidget(size_widget)
+
         left_layout.addWidget(self.params_widget)
         self.toggle_default_params()
 
@@ -346,6 +371,20 @@ class ImageApp(QMainWindow):
         self.generate_btn.clicked.connect(self.start_processing)
         left_layout.addWidget(self.generate_btn)
 
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setFont(LARGE_FONT)
+        self.cancel_btn.setStyleSheet(f"""
+            background-color: {CANCEL_BUTTON_COLOR};
+            color: white;
+            border-radius: 30px;
+            padding: 15px;
+            margin: 10px;
+        """)
+        self.cancel_btn.setMinimumHeight(60)
+        self.cancel_btn.clicked.connect(self.cancel_processing)
+        self.cancel_btn.setVisible(False)
+        left_layout.addWidget(self.cancel_btn)
+
         self.eta_label = QLabel("ETA: -- s")
         self.eta_label.setFont(LARGE_FONT)
         self.eta_label.setStyleSheet("margin: 10px;")
@@ -474,6 +513,8 @@ class ImageApp(QMainWindow):
             self.strength_input.setText(str(params["STRENGTH"]))
             self.cfg_scale_input.setText(str(params["CFG_SCALE"]))
             self.steps_input.setText(str(params["INFERENCE_STEPS"]))
+            self.width_input.setText(str(DEFAULT_WIDTH))
+            self.height_input.setText(str(DEFAULT_HEIGHT))
 
     def switch_mode(self, mode):
         if mode == self.current_mode:
@@ -577,6 +618,9 @@ class ImageApp(QMainWindow):
         self.default_params_checkbox.setEnabled(False)
         self.params_widget.setEnabled(False)
         self.generate_btn.setEnabled(False)
+        self.cancel_btn.setText("Cancel")
+        self.cancel_btn.setEnabled(True)
+        self.cancel_btn.setVisible(True)
         self.download_btn.setVisible(False)
         self.progress_bar.setVisible(True)
         self.eta_label.setVisible(True)
@@ -598,6 +642,8 @@ class ImageApp(QMainWindow):
             strength = params["STRENGTH"]
             cfg_scale = params["CFG_SCALE"]
             num_inference_steps = params["INFERENCE_STEPS"]
+            width = DEFAULT_WIDTH
+            height = DEFAULT_HEIGHT
         else:
             try:
                 strength = float(self.strength_input.text())
@@ -609,36 +655,45 @@ class ImageApp(QMainWindow):
                 num_inference_steps = int(self.steps_input.text())
                 if not 1 <= num_inference_steps <= 200:
                     raise ValueError("Inference Steps must be between 1 and 200")
+                width = int(self.width_input.text())
+                height = int(self.height_input.text())
+                if not (64 <= width <= 1024 and 64 <= height <= 1024) or width % 64 or height % 64:
+                    raise ValueError("Width and Height must be multiples of 64 between 64 and 1024")
             except ValueError as e:
                 QMessageBox.warning(self, "Error", f"Invalid parameter values: {str(e)}")
                 self.cleanup()
                 return
         do_cfg = True
-        # Map dropdown selection to sampler value
-        sampler_map = {
-            "DDPM": "ddpm",
-            "DDIM": "ddim",
-            "DDIM - Dynamic Step Skipping": "ddim-dss"
-        }
-        sampler = sampler_map[self.sampler_dropdown.currentText()]
+        sampler = self.sampler_dropdown.currentData()
         seed = DEFAULT_SEED
 
         image_path = self.image_path if self.current_mode in ["Image-to-Image", "Image-InPainting"] else None
 
         self.thread = QThread()
-        self.worker = Worker(image_path, sentence, uncond_prompt, strength, do_cfg, cfg_scale, sampler, num_inference_steps, seed)
+        self.worker = Worker(image_path, sentence, uncond_prompt, strength, do_cfg, cfg_scale, sampler, num_inference_steps, seed, width, height)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.progress.connect(self.update_progress)
+        self.worker.preview.connect(self.update_preview)
         self.worker.finished.connect(self.on_processing_finished)
         self.worker.error.connect(self.on_processing_error)
+        self.worker.cancelled.connect(self.on_processing_cancelled)
         self.thread.finished.connect(self.thread.deleteLater)
         self.thread.start()
+        self.processing = True
 
         self.elapsed_timer = QTimer()
         self.elapsed_timer.timeout.connect(self.update_elapsed_time)
         self.elapsed_timer.start(100)
 
+    def cancel_processing(self):
+        if not self.processing:
+            return
+        # The worker is busy in its thread, so the token is set directly instead of through a signal
+        self.worker.cancel()
+        self.cancel_btn.setText("Cancelling...")
+        self.cancel_btn.setEnabled(False)
+
     def start_gradient_animation(self):
         self.animation = QPropertyAnimation(self, b"gradient")
         self.animation.setDuration(2000)
@@ -667,6 +722,12 @@ class ImageApp(QMainWindow):
         else:
             self.eta_label.setText("ETA: -- s")
 
+    def update_preview(self, preview_image):
+        pixmap = numpy_to_pixmap(preview_image)
+        if not pixmap.isNull():
+            scaled_pixmap = pixmap.scaled(512, 320, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            self.output_image_label.setPixmap(scaled_pixmap)
+
     def update_elapsed_time(self):
         elapsed_time = time.time() - self.start_time
         self.elapsed_label.setText(f"Elapsed: {elapsed_time:.1f} s")
@@ -708,6 +769,21 @@ class ImageApp(QMainWindow):
         self.setup_requirements_btn.setVisible(True)
         self.cleanup()
 
+    def on_processing_cancelled(self):
+        if hasattr(self, 'animation'):
+            self.animation.stop()
+            self.output_image_label.setStyleSheet("""
+                border: 1px dotted black;
+                border-radius: 15px;
+                padding: 15px;
+                margin: 10px;
+                background-color: #f0f0f0;
+            """)
+        self.elapsed_timer.stop()
+        self.output_image_label.setPixmap(QPixmap())
+        self.output_image_label.setText("Generation cancelled")
+        self.cleanup()
+
     def cleanup(self):
         self.load_btn.setEnabled(True)
         self.sentence_input.setEnabled(True)
@@ -715,11 +791,23 @@ class ImageApp(QMainWindow):
         self.default_params_checkbox.setEnabled(True)
         self.params_widget.setEnabled(True)
         self.generate_btn.setEnabled(True)
+        self.cancel_btn.setVisible(False)
         self.progress_bar.setVisible(False)
         self.eta_label.setVisible(False)
         self.elapsed_label.setVisible(False)
-        self.thread.quit()
-        self.thread.wait()
+        if self.processing:
+            self.processing = False
+            self.thread.quit()
+            self.thread.wait()
+
+    def closeEvent(self, event):
+        # Stop a running generation instead of leaving its thread busy after the window is gone
+        if self.processing:
+            self.worker.cancel()
+            self.thread.quit()
+            self.thread.wait()
+            self.processing = False
+        super().closeEvent(event)
 
     @pyqtProperty(QColor)
     def gradient(self):
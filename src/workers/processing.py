@@ -1,14 +1,17 @@
 import numpy as np
 from PyQt5.QtCore import QObject, pyqtSignal
 from sd.demo import generate_image
+from sd.cancellation import CancellationToken, GenerationCancelled
 from PIL import Image
 
 class Worker(QObject):
     progress = pyqtSignal(int, int, float)  # step, total_steps, step_time
+    preview = pyqtSignal(np.ndarray)  # approximate image while sampling
     finished = pyqtSignal(np.ndarray)  # output_image
     error = pyqtSignal(str)  # error_message
+    cancelled = pyqtSignal()
 
-    def __init__(self, image_path, sentence, uncond_prompt, strength, do_cfg, cfg_scale, sampler, num_inference_steps, seed):
+    def __init__(self, image_path, sentence, uncond_prompt, strength, do_cfg, cfg_scale, sampler, num_inference_steps, seed, width=512, height=512):
         super().__init__()
         self.image_path = image_path
         self.sentence = sentence
@@ -19,10 +22,20 @@ class Worker(QObject):
         self.sampler = sampler
         self.num_inference_steps = num_inference_steps
         self.seed = seed
+        self.width = width
+        self.height = height
+        self.cancel_token = CancellationToken()
 
     def progress_callback(self, step, total_steps, step_time):
         self.progress.emit(step, total_steps, step_time)
 
+    def cancel(self):
+        # Called from the UI thread, the running generation stops at its next step
+        self.cancel_token.cancel()
+
+    def preview_callback(self, image):
+        self.preview.emit(image)
+
     def run(self):
         try:
             input_image = None
@@ -39,9 +52,15 @@ class Worker(QObject):
                 sampler=self.sampler,
                 num_inference_steps=self.num_inference_steps,
                 seed=self.seed,
-                progress_callback=self.progress_callback
+                progress_callback=self.progress_callback,
+                preview_callback=self.preview_callback,
+                cancel_token=self.cancel_token,
+                width=self.width,
+                height=self.height
             )
             self.finished.emit(output_image)
+        except GenerationCancelled:
+            self.cancelled.emit()
         except FileNotFoundError as e:
             self.error.emit(f"Missing checkpoint file: {str(e)}. Please run setup.")
         except Exception as e: